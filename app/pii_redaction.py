@@ -9,6 +9,12 @@ from pathlib import Path
 from cryptography.fernet import Fernet
 import PyPDF2
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 try:
     import spacy
     SPACY_AVAILABLE = True
@@ -289,7 +295,8 @@ class PIIEncryption:
         
         # Decrypt and deserialize
         decrypted_data = fernet.decrypt(encrypted_data.encode())
-        pii_mapping = json.loads(decrypted_data.decode())
+        # orjson parses the decrypted bytes directly, without decoding to str first
+        pii_mapping = orjson.loads(decrypted_data) if ORJSON_AVAILABLE else json.loads(decrypted_data.decode())
         
         return pii_mapping
     
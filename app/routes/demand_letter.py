@@ -6,7 +6,7 @@ from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
-from .gemini_client import generate_demand_letter
+from .gemini_client import demand_letter_batcher
 import sys
 import os
 
@@ -106,8 +106,9 @@ async def generate_demand_letter_endpoint(request: DemandLetterRequest):
         # Generate the demand letter
         # Note: generate_demand_letter expects the dict structure directly
         # Validation will fill in defaults if sender/recipient are missing
-        print("[GENERATE] Calling generate_demand_letter...")
-        result = generate_demand_letter(request_dict)
+        # Concurrent requests are batched into a single Gemini call
+        print("[GENERATE] Queueing demand letter generation...")
+        result = await demand_letter_batcher.submit(request_dict)
         
         print(f"[RESULT] Received result: success={result.get('success')}")
         
@@ -2,11 +2,22 @@
 Gemini client for demand letter generation
 """
 import google.generativeai as genai
+import asyncio
+import json
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import sys
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Batched Gemini responses are parsed with orjson when installed (several KB of JSON each)
+_parse_json = orjson.loads if ORJSON_AVAILABLE else json.loads
+
 # Add scripts directory to path - get the root of clause_backend
 current_dir = os.path.dirname(os.path.abspath(__file__))  # routes/
 app_dir = os.path.dirname(current_dir)  # app/
@@ -17,8 +28,10 @@ sys.path.insert(0, scripts_dir)
 try:
     from demand_letter_helpers import (
         build_user_prompt,
+        build_batched_user_prompt,
         validate_latex,
-        clean_latex_output
+        clean_latex_output,
+        MAX_BATCH_SIZE
     )
 except ImportError as e:
     print(f"[ERROR] Failed to import demand_letter_helpers: {e}")
@@ -53,6 +66,16 @@ Requirements:
 - Massachusetts law only
 - Ready to copy/paste"""
 
+# How long to collect concurrent requests before sending them as one batched
+# Gemini call. Set to 0 to always use the single-letter path.
+BATCH_WINDOW_MS = int(os.environ.get('DEMAND_LETTER_BATCH_WINDOW_MS', '50'))
+
+# Output budget per letter, and the model's output ceiling - a batched call asks
+# for LETTER_MAX_OUTPUT_TOKENS per case, so batches are split to stay under it
+LETTER_MAX_OUTPUT_TOKENS = 1500
+GEMINI_MAX_OUTPUT_TOKENS = int(os.environ.get('GEMINI_MAX_OUTPUT_TOKENS', '8192'))
+LETTERS_PER_CALL = max(1, min(MAX_BATCH_SIZE, GEMINI_MAX_OUTPUT_TOKENS // LETTER_MAX_OUTPUT_TOKENS))
+
 
 def initialize_gemini():
     """Initialize Gemini client with API key from environment"""
@@ -78,6 +101,56 @@ def initialize_gemini():
     )
 
 
+def _limit_highlights(analysis_json, limit=3):
+    """Limit to the top highlights with highest damages to minimize tokens"""
+    highlights = analysis_json.get('highlights', [])
+    if len(highlights) <= limit:
+        return analysis_json
+    
+    # Sort by damages_estimate and take top N
+    sorted_highlights = sorted(
+        highlights, 
+        key=lambda h: h.get('damages_estimate', 0) or 0, 
+        reverse=True
+    )[:limit]
+    analysis_json_optimized = analysis_json.copy()
+    analysis_json_optimized['highlights'] = sorted_highlights
+    # Update issues_found in summary to reflect reduction
+    if 'analysisSummary' in analysis_json_optimized:
+        analysis_json_optimized['analysisSummary'] = analysis_json_optimized['analysisSummary'].copy()
+        analysis_json_optimized['analysisSummary']['issuesFound'] = limit
+    print(f"   [OPTIMIZED] Reduced highlights from {len(highlights)} to {limit} (top damages) to save tokens")
+    return analysis_json_optimized
+
+
+def _build_success_result(letter_text, request_data):
+    """Build the successful response dict for a generated letter"""
+    # Calculate deadline date
+    deadline_days = request_data.get('preferences', {}).get('deadline_days', 30)
+    deadline_date = datetime.now() + timedelta(days=deadline_days)
+    
+    # Calculate total damages
+    highlights = request_data.get('analysis_json', {}).get('highlights', [])
+    total_damages = sum(
+        (h.get('damages_estimate', 0) or 0) 
+        for h in highlights
+    )
+    
+    # Return successful response - use 'letter_text' instead of 'latex_source' for clarity
+    return {
+        'success': True,
+        'latex_source': letter_text,  # Keep field name for compatibility
+        'letter_text': letter_text,   # Also provide as letter_text
+        'metadata': {
+            'generated_at': datetime.now().isoformat(),
+            'total_damages': total_damages,
+            'issues_count': len(highlights),
+            'deadline_date': deadline_date.strftime('%Y-%m-%d'),
+            'model_used': os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash-exp').replace('models/', '')
+        }
+    }
+
+
 def generate_demand_letter(request_data):
     """
     Generate demand letter using Gemini API
@@ -105,40 +178,15 @@ def generate_demand_letter(request_data):
         print(f"     - Recipient: {recipient.get('name', 'N/A')}")
         print(f"     - Highlights: {len(analysis_json.get('highlights', []))}")
         
+        # Optimize prompt length to reduce token usage for free tier
         user_prompt = build_user_prompt(
             prompt,
-            analysis_json,
+            _limit_highlights(analysis_json),
             sender,
             recipient,
             preferences
         )
         
-        # Optimize prompt length to reduce token usage for free tier
-        # Limit to top 3 highlights with highest damages to minimize tokens
-        highlights = analysis_json.get('highlights', [])
-        if len(highlights) > 3:
-            # Sort by damages_estimate and take top 3
-            sorted_highlights = sorted(
-                highlights, 
-                key=lambda h: h.get('damages_estimate', 0) or 0, 
-                reverse=True
-            )[:3]
-            analysis_json_optimized = analysis_json.copy()
-            analysis_json_optimized['highlights'] = sorted_highlights
-            # Update issues_found in summary to reflect reduction
-            if 'analysisSummary' in analysis_json_optimized:
-                analysis_json_optimized['analysisSummary'] = analysis_json_optimized['analysisSummary'].copy()
-                analysis_json_optimized['analysisSummary']['issuesFound'] = 3
-            # Rebuild prompt with optimized data
-            user_prompt = build_user_prompt(
-                prompt,
-                analysis_json_optimized,
-                sender,
-                recipient,
-                preferences
-            )
-            print(f"   [OPTIMIZED] Reduced highlights from {len(highlights)} to 3 (top damages) to save tokens")
-        
         print("Generating demand letter with Gemini...")
         print(f"   Prompt length: {len(user_prompt)} characters (~{len(user_prompt) // 4} tokens)")
         model_name = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash-exp')
@@ -157,7 +205,7 @@ def generate_demand_letter(request_data):
                         'temperature': 0.3,  # Lower temperature for consistent, formal output
                         'top_p': 0.95,
                         'top_k': 40,
-                        'max_output_tokens': 1500,  # Reduced further for free tier (was 4096)
+                        'max_output_tokens': LETTER_MAX_OUTPUT_TOKENS,  # Reduced further for free tier (was 4096)
                     }
                 )
                 print("[OK] Gemini API call successful")
@@ -221,30 +269,7 @@ def generate_demand_letter(request_data):
             print(f"[WARN] Validation warning: Generated content may be incomplete, but returning anyway")
             # Don't fail - return the content
         
-        # Calculate deadline date
-        deadline_days = request_data.get('preferences', {}).get('deadline_days', 30)
-        deadline_date = datetime.now() + timedelta(days=deadline_days)
-        
-        # Calculate total damages
-        highlights = request_data.get('analysis_json', {}).get('highlights', [])
-        total_damages = sum(
-            (h.get('damages_estimate', 0) or 0) 
-            for h in highlights
-        )
-        
-        # Return successful response - use 'letter_text' instead of 'latex_source' for clarity
-        return {
-            'success': True,
-            'latex_source': letter_text,  # Keep field name for compatibility
-            'letter_text': letter_text,   # Also provide as letter_text
-            'metadata': {
-                'generated_at': datetime.now().isoformat(),
-                'total_damages': total_damages,
-                'issues_count': len(highlights),
-                'deadline_date': deadline_date.strftime('%Y-%m-%d'),
-                'model_used': os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash-exp').replace('models/', '')
-            }
-        }
+        return _build_success_result(letter_text, request_data)
         
     except Exception as e:
         print(f"Error generating demand letter: {str(e)}")
@@ -256,3 +281,174 @@ def generate_demand_letter(request_data):
             'error_code': 'GENERATION_FAILED'
         }
 
+
+
+def _case_names(request_data):
+    """Lower-cased sender/recipient names for one case, skipping [PLACEHOLDER] values"""
+    names = set()
+    for party in (request_data.get('sender') or {}, request_data.get('recipient') or {}):
+        name = ' '.join(str(party.get('name') or '').split()).lower()
+        if name and not name.startswith('['):
+            names.add(name)
+    return names
+
+
+def _letter_mentions(letter, name):
+    # LaTeX escapes (\&, \_), ties (~) and line wrapping would otherwise hide a name
+    return name in ' '.join(letter.replace('\\', '').replace('~', ' ').split()).lower()
+
+
+def _generate_batch(requests_data, preferences):
+    """Generate several letters sharing the same preferences with a single Gemini call"""
+    model = initialize_gemini()
+    cases = [
+        {
+            'analysis_json': _limit_highlights(r.get('analysis_json', {})),
+            'sender': r.get('sender', {}),
+            'recipient': r.get('recipient', {})
+        }
+        for r in requests_data
+    ]
+    batched_prompt = build_batched_user_prompt(cases, preferences)
+    
+    print(f"Generating {len(cases)} demand letters with one batched Gemini call...")
+    print(f"   Prompt length: {len(batched_prompt)} characters (~{len(batched_prompt) // 4} tokens)")
+    
+    response = model.generate_content(
+        batched_prompt,
+        generation_config={
+            'temperature': 0.3,
+            'top_p': 0.95,
+            'top_k': 40,
+            'max_output_tokens': min(GEMINI_MAX_OUTPUT_TOKENS, LETTER_MAX_OUTPUT_TOKENS * len(cases)),
+            'response_mime_type': 'application/json',
+        }
+    )
+    
+    # JSON mode returns bare JSON - the fence strip only guards against a stray wrapper
+    response_text = clean_latex_output(response.text)
+    letters = {}
+    for entry in _parse_json(response_text).get('letters', []):
+        try:
+            letters[int(entry['case_id'])] = entry.get('letter', '')
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue  # Malformed entry - its case falls back to a single call below
+    
+    case_names = [_case_names(r) for r in requests_data]
+    results = []
+    for case_id, request_data in enumerate(requests_data, 1):
+        letter = letters.get(case_id)
+        if not letter or len(letter) < 50:
+            # Missing or truncated entry - regenerate this one on its own
+            print(f"[WARN] Batched response missing case {case_id}, falling back to single call")
+            results.append(generate_demand_letter(request_data))
+            continue
+        # The batch prompt holds every case's parties - never return a letter that
+        # lost its own names or picked up someone else's
+        own_names = case_names[case_id - 1]
+        other_names = set().union(*case_names) - own_names
+        if (not all(_letter_mentions(letter, n) for n in own_names)
+                or any(_letter_mentions(letter, n) for n in other_names)):
+            print(f"[WARN] Batched letter for case {case_id} has mismatched party names, falling back to single call")
+            results.append(generate_demand_letter(request_data))
+            continue
+        results.append(_build_success_result(clean_latex_output(letter), request_data))
+    return results
+
+
+def generate_demand_letters_batch(requests_data):
+    """
+    Generate demand letters for several requests, batching prompts where possible
+    
+    Requests are grouped by preferences (tone/deadline are part of the shared
+    instructions) and sent LETTERS_PER_CALL at a time. Groups of one use the
+    regular single-letter path, and a batch whose call fails is regenerated
+    one letter at a time.
+    
+    Args:
+        requests_data: List of request dicts as accepted by generate_demand_letter
+    
+    Returns:
+        List of result dicts in the same order as requests_data
+    """
+    results = [None] * len(requests_data)
+    
+    groups = {}
+    for i, request_data in enumerate(requests_data):
+        preferences = request_data.get('preferences', {})
+        key = (preferences.get('tone', 'firm'), preferences.get('deadline_days', 30))
+        groups.setdefault(key, []).append(i)
+    
+    for indices in groups.values():
+        for start in range(0, len(indices), LETTERS_PER_CALL):
+            batch = indices[start:start + LETTERS_PER_CALL]
+            if len(batch) == 1:
+                results[batch[0]] = generate_demand_letter(requests_data[batch[0]])
+                continue
+            
+            batch_requests = [requests_data[i] for i in batch]
+            try:
+                batch_results = _generate_batch(batch_requests, batch_requests[0].get('preferences', {}))
+            except Exception as e:
+                print(f"[WARN] Batched demand letter call failed ({e}), falling back to single calls")
+                batch_results = [generate_demand_letter(request_data) for request_data in batch_requests]
+            for i, result in zip(batch, batch_results):
+                results[i] = result
+    
+    return results
+
+
+class DemandLetterBatcher:
+    """Collect demand letter requests over a short window and generate them together"""
+    
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._flush_handle = None
+        # The event loop only keeps weak references to tasks - hold running batches here
+        self._tasks = set()
+    
+    async def submit(self, request_data):
+        """Queue a request and wait for its result"""
+        if self.window <= 0:
+            return await asyncio.to_thread(generate_demand_letter, request_data)
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request_data, future))
+        
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch):
+        requests_data = [request_data for request_data, _ in batch]
+        try:
+            results = await asyncio.to_thread(generate_demand_letters_batch, requests_data)
+        except Exception as e:
+            results = [{
+                'success': False,
+                'error': str(e),
+                'error_code': 'GENERATION_FAILED'
+            } for _ in batch]
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+demand_letter_batcher = DemandLetterBatcher()
@@ -7,7 +7,7 @@ import uuid
 from datetime import datetime
 
 from pii_redaction import redact_pdf, PIIEncryption, save_redacted_mapping
-from utils.storage import load_storage, save_storage
+from utils.storage import add_document
 
 router = APIRouter()
 
@@ -68,8 +68,7 @@ async def upload_document(file: UploadFile = File(...)):
             redacted_path = None
         
         # Store metadata
-        storage = load_storage()
-        storage[file_id] = {
+        doc = {
             "file_id": file_id,
             "filename": file.filename,
             "file_path": str(file_path),
@@ -81,13 +80,13 @@ async def upload_document(file: UploadFile = File(...)):
             "message": "Document uploaded and PII redacted",
             "pii_redacted": redaction_summary
         }
-        save_storage(storage)
+        add_document(file_id, doc)
         
         return {
             "file_id": file_id,
             "filename": file.filename,
             "size": len(contents),
-            "upload_time": storage[file_id]["uploaded_at"],
+            "upload_time": doc["uploaded_at"],
             "pii_redacted": redaction_summary,
             "message": "File uploaded and PII redacted successfully"
         }
@@ -2,21 +2,47 @@
 Main server file that combines API and static file serving
 """
 import uvicorn
+import re
+from fastapi import Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
 from api_v2 import app
 import os
 
+# Assets with a content hash in the name (e.g. app.3f9a1c2b.js) never change, so
+# browsers may keep them for a year; everything else (index.html) must revalidate
+# against the ETag/Last-Modified that StaticFiles sends on every request
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+FINGERPRINTED_ASSET_RE = re.compile(r'[.-][0-9a-f]{8,}\.[A-Za-z0-9]+$')
+
+
+@app.middleware("http")
+async def add_static_cache_headers(request: Request, call_next):
+    """Add Cache-Control headers to static asset and frontend responses"""
+    response = await call_next(request)
+    path = request.url.path
+    if (path.startswith("/static/") or path == "/app" or path.startswith("/app/")) \
+            and response.status_code in (200, 304):
+        if FINGERPRINTED_ASSET_RE.search(path):
+            response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        else:
+            response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+    return response
+
+
 # Mount static files directory
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 if os.path.exists(static_dir):
     app.mount("/static", StaticFiles(directory=static_dir), name="static")
+    frontend_files = StaticFiles(directory=static_dir, html=True)
+
+    # Serve index.html at /app itself (no redirect to /app/) with ETag/Last-Modified handling
+    @app.get("/app", include_in_schema=False)
+    async def serve_app(request: Request):
+        """Serve the frontend application"""
+        return await frontend_files.get_response("index.html", request.scope)
 
-# Serve index.html at root
-@app.get("/app", response_class=FileResponse)
-async def serve_app():
-    """Serve the frontend application"""
-    return os.path.join(static_dir, "index.html")
+    app.mount("/app", frontend_files, name="app")
 
 if __name__ == "__main__":
     print("="*80)
@@ -143,23 +143,23 @@ def run_full_analysis(file_id: str, file_path: str, user_metadata: dict = None):
         # Chunk document
         lease_chunks = chunker.chunk_document(lease_text, max_tokens=4000)
         
+        # Embed every chunk and find its relevant laws in one Snowflake query
+        laws_by_chunk = analyzer.search_relevant_laws_batch([chunk['text'] for chunk in lease_chunks], top_k=8)
+        laws_per_chunk = [laws_by_chunk[i] for i in range(len(lease_chunks))]
+        
         update_document(file_id, {
             "progress": 50,
             "message": f"Analyzing {len(lease_chunks)} chunks against MA laws..."
         })
         
-        # Analyze each chunk
-        chunk_analyses = []
-        for i, chunk in enumerate(lease_chunks):
-            progress = 50 + int((i / len(lease_chunks)) * 35)
+        def report_progress(completed, total):
             update_document(file_id, {
-                "progress": progress,
-                "message": f"Analyzing chunk {i+1}/{len(lease_chunks)}..."
+                "progress": 50 + int((completed / total) * 35),
+                "message": f"Analyzed chunk {completed}/{total}..."
             })
-            
-            relevant_laws = analyzer.search_relevant_laws(chunk['text'], top_k=8)
-            analysis = analyzer.analyze_chunk(chunk, relevant_laws)
-            chunk_analyses.append(analysis)
+        
+        # Analyze each chunk (this is the main API call usage) - the Gemini calls run concurrently
+        chunk_analyses = analyzer.analyze_chunks(lease_chunks, laws_per_chunk, report_progress)
         
         update_document(file_id, {
             "progress": 85,
@@ -252,23 +252,23 @@ def run_analysis_task(file_id: str, file_path: str):
         # Chunk document
         lease_chunks = chunker.chunk_document(lease_text, max_tokens=4000)
         
+        # Embed every chunk and find its relevant laws in one Snowflake query
+        laws_by_chunk = analyzer.search_relevant_laws_batch([chunk['text'] for chunk in lease_chunks], top_k=8)
+        laws_per_chunk = [laws_by_chunk[i] for i in range(len(lease_chunks))]
+        
         update_document(file_id, {
             "progress": 40,
             "message": f"Analyzing {len(lease_chunks)} chunks against MA laws..."
         })
         
-        # Analyze each chunk (this is the main API call usage)
-        chunk_analyses = []
-        for i, chunk in enumerate(lease_chunks):
-            progress = 40 + int((i / len(lease_chunks)) * 40)
+        def report_progress(completed, total):
             update_document(file_id, {
-                "progress": progress,
-                "message": f"Analyzing chunk {i+1}/{len(lease_chunks)}..."
+                "progress": 40 + int((completed / total) * 40),
+                "message": f"Analyzed chunk {completed}/{total}..."
             })
-            
-            relevant_laws = analyzer.search_relevant_laws(chunk['text'], top_k=8)
-            analysis = analyzer.analyze_chunk(chunk, relevant_laws)
-            chunk_analyses.append(analysis)
+        
+        # Analyze each chunk (this is the main API call usage) - the Gemini calls run concurrently
+        chunk_analyses = analyzer.analyze_chunks(lease_chunks, laws_per_chunk, report_progress)
         
         update_document(file_id, {
             "progress": 85,
@@ -276,13 +276,10 @@ def run_analysis_task(file_id: str, file_path: str):
         })
         
         # Get basic file info without calling Gemini
-        import PyPDF2
         page_count = None
         file_size = None
         try:
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                page_count = len(pdf_reader.pages)
+            page_count = PDFExtractor.get_page_count(file_path)
             file_size = os.path.getsize(file_path)
         except:
             pass
@@ -1,53 +1,148 @@
 """
 Document storage utilities
+
+Reads are served from an in-memory copy of the JSON file that is reloaded
+whenever the file's mtime or size shows another process wrote it. Readers get
+deep copies so the shared dict is only ever touched under the locks. Mutations
+write through: they re-check the file under the storage lock, apply only
+their own change and atomically replace the file before returning.
 """
+import copy
 import json
+import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from fastapi import HTTPException
 
+try:
+    import fcntl
+except ImportError:  # Windows - fall back to unlocked access
+    fcntl = None
+
 
 STORAGE_FILE = Path("data/documents.json")
 STORAGE_FILE.parent.mkdir(exist_ok=True)
+LOCK_FILE = STORAGE_FILE.with_suffix('.json.lock')
+TMP_FILE = STORAGE_FILE.with_suffix('.json.tmp')
 
+_cache = None
+_cache_signature = None
+_cache_lock = threading.RLock()
 
-def load_storage():
-    """Load document storage from JSON file"""
+
+@contextmanager
+def _storage_lock():
+    """Hold an exclusive lock on the storage file across a read-modify-write"""
+    with open(LOCK_FILE, 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _file_signature():
+    try:
+        stat = STORAGE_FILE.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_storage():
     if STORAGE_FILE.exists():
         with open(STORAGE_FILE, 'r') as f:
             return json.load(f)
     return {}
 
 
+def _write_storage(storage):
+    # Write to a temp file and atomically swap it in so a crash mid-write
+    # never leaves a truncated documents.json behind
+    with open(TMP_FILE, 'w') as f:
+        json.dump(storage, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(TMP_FILE, STORAGE_FILE)
+
+
+def _refresh_cache():
+    """Reload the cache if the file changed on disk - caller holds _storage_lock"""
+    global _cache, _cache_signature
+    signature = _file_signature()
+    if _cache is None or signature != _cache_signature:
+        _cache = _read_storage()
+        _cache_signature = signature
+    return _cache
+
+
+def _read_cached(select):
+    """Return a deep copy of select(storage), reloading the cache if the file changed"""
+    with _cache_lock:
+        if _cache is None or _file_signature() != _cache_signature:
+            with _storage_lock():
+                _refresh_cache()
+        return copy.deepcopy(select(_cache))
+
+
+@contextmanager
+def _locked_storage():
+    """Yield up-to-date storage for one mutation, then write it through to disk"""
+    global _cache, _cache_signature
+    with _cache_lock, _storage_lock():
+        storage = _refresh_cache()
+        yield storage
+        try:
+            _write_storage(storage)
+        except Exception:
+            _cache = None  # Drop the unsaved change so the next read reloads the file
+            raise
+        _cache_signature = _file_signature()
+
+
+def load_storage():
+    """Load document storage from JSON file"""
+    return _read_cached(lambda storage: storage)
+
+
 def save_storage(storage):
     """Save document storage to JSON file"""
-    with open(STORAGE_FILE, 'w') as f:
-        json.dump(storage, f, indent=2)
+    global _cache, _cache_signature
+    with _cache_lock, _storage_lock():
+        _write_storage(storage)
+        _cache = copy.deepcopy(storage)
+        _cache_signature = _file_signature()
 
 
 def get_document(file_id: str):
     """Get document metadata from storage"""
-    storage = load_storage()
-    if file_id not in storage:
+    doc = _read_cached(lambda storage: storage.get(file_id))
+    if doc is None:
         raise HTTPException(status_code=404, detail="Document not found")
-    return storage[file_id]
+    return doc
+
+
+def add_document(file_id: str, doc: dict):
+    """Add a new document record to storage"""
+    with _locked_storage() as storage:
+        storage[file_id] = copy.deepcopy(doc)
 
 
 def update_document(file_id: str, updates: dict):
     """Update document metadata in storage"""
-    storage = load_storage()
-    if file_id not in storage:
-        raise HTTPException(status_code=404, detail="Document not found")
-    storage[file_id].update(updates)
-    save_storage(storage)
+    with _locked_storage() as storage:
+        if file_id not in storage:
+            raise HTTPException(status_code=404, detail="Document not found")
+        storage[file_id].update(copy.deepcopy(updates))
 
 
 def delete_document_from_storage(file_id: str):
     """Delete document from storage"""
-    storage = load_storage()
-    if file_id not in storage:
-        raise HTTPException(status_code=404, detail="Document not found")
-    doc = storage[file_id]
-    del storage[file_id]
-    save_storage(storage)
+    with _locked_storage() as storage:
+        doc = storage.pop(file_id, None)
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Document not found")
     return doc
-
@@ -2,7 +2,69 @@
 Document chunking module
 """
 import re
-from typing import List, Dict
+import numpy as np
+from typing import List, Dict, Iterator
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+
+
+def _iter_paragraphs(text: str) -> Iterator[str]:
+    """Lazily yield non-empty, stripped paragraphs separated by blank lines"""
+    start = 0
+    while True:
+        end = text.find('\n\n', start)
+        para = (text[start:] if end == -1 else text[start:end]).strip()
+        if para:
+            yield para
+        if end == -1:
+            return
+        start = end + 2
+
+
+def _paragraph_chunk_boundaries(lengths, max_tokens):
+    """
+    Compute chunk boundaries from paragraph lengths (in characters)
+    
+    Mirrors the paragraph path of DocumentChunker.chunk_document: each chunk
+    after the first starts with the previous chunk's last paragraph as overlap.
+    Only valid when no single paragraph exceeds max_tokens. Works on plain
+    integers so it can be compiled with numba.
+    
+    Returns:
+        Tuple of (starts, ends) arrays; chunk k is paragraphs[starts[k]:ends[k]]
+    """
+    n = len(lengths)
+    starts = np.empty(n, dtype=np.int64)
+    ends = np.empty(n, dtype=np.int64)
+    count = 0
+    start = 0
+    tokens = 0
+    for i in range(n):
+        para_tokens = lengths[i] // 4
+        if tokens + para_tokens > max_tokens and i > start:
+            starts[count] = start
+            ends[count] = i
+            count += 1
+            # Keep last paragraph for overlap
+            start = i - 1
+            tokens = (lengths[i - 1] + 1 + lengths[i]) // 4
+        else:
+            tokens += para_tokens
+    if n > start:
+        starts[count] = start
+        ends[count] = n
+        count += 1
+    return starts[:count], ends[:count]
+
+
+if NUMBA_AVAILABLE:
+    _paragraph_chunk_boundaries = numba.njit(cache=True)(_paragraph_chunk_boundaries)
 
 
 class DocumentChunker:
@@ -26,9 +88,36 @@ class DocumentChunker:
         Returns:
             List of chunks with metadata
         """
-        # Split into paragraphs
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
+        paragraphs = list(_iter_paragraphs(text))
+        lengths = np.fromiter((len(p) for p in paragraphs), dtype=np.int64, count=len(paragraphs))
+        
+        if np.all(lengths // 4 <= max_tokens):
+            # No paragraph needs sentence splitting - boundaries depend only on lengths
+            starts, ends = _paragraph_chunk_boundaries(lengths, max_tokens)
+            chunks = []
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                chunk_text = ' '.join(paragraphs[start:end])
+                chunks.append({
+                    'text': chunk_text,
+                    'tokens': self.estimate_tokens(chunk_text),
+                    'chunk_index': len(chunks) + 1
+                })
+        else:
+            chunks = self._chunk_paragraphs(paragraphs, max_tokens)
+        
+        # Add total_chunks to all
+        total = len(chunks)
+        for chunk in chunks:
+            chunk['total_chunks'] = total
         
+        print(f"\n📦 Created {len(chunks)} chunks from document")
+        for chunk in chunks:
+            print(f"   Chunk {chunk['chunk_index']}/{chunk['total_chunks']}: {chunk['tokens']} tokens")
+        
+        return chunks
+    
+    def _chunk_paragraphs(self, paragraphs: List[str], max_tokens: int) -> List[Dict]:
+        """Chunk paragraphs, splitting oversized ones by sentence"""
         chunks = []
         current_chunk = []
         current_tokens = 0
@@ -38,7 +127,7 @@ class DocumentChunker:
             
             # If single paragraph exceeds max, split it by sentences
             if para_tokens > max_tokens:
-                sentences = re.split(r'(?<=[.!?])\s+', para)
+                sentences = _SENT_SPLIT.split(para)
                 for sentence in sentences:
                     sentence_tokens = self.estimate_tokens(sentence)
                     
@@ -53,7 +142,8 @@ class DocumentChunker:
                             # Keep last few sentences for overlap
                             overlap_text = ' '.join(current_chunk[-2:]) if len(current_chunk) >= 2 else ''
                             current_chunk = [overlap_text, sentence] if overlap_text else [sentence]
-                            current_tokens = self.estimate_tokens(' '.join(current_chunk))
+                            # Equivalent to estimate_tokens(' '.join(current_chunk)) without re-joining
+                            current_tokens = (len(overlap_text) + 1 + len(sentence)) // 4 if overlap_text else sentence_tokens
                         else:
                             current_chunk = [sentence]
                             current_tokens = sentence_tokens
@@ -73,7 +163,8 @@ class DocumentChunker:
                     # Keep last paragraph for overlap
                     overlap_text = current_chunk[-1] if current_chunk else ''
                     current_chunk = [overlap_text, para] if overlap_text else [para]
-                    current_tokens = self.estimate_tokens(' '.join(current_chunk))
+                    # Equivalent to estimate_tokens(' '.join(current_chunk)) without re-joining
+                    current_tokens = (len(overlap_text) + 1 + len(para)) // 4 if overlap_text else para_tokens
                 else:
                     current_chunk = [para]
                     current_tokens = para_tokens
@@ -90,14 +181,5 @@ class DocumentChunker:
                 'chunk_index': len(chunks) + 1
             })
         
-        # Add total_chunks to all
-        total = len(chunks)
-        for chunk in chunks:
-            chunk['total_chunks'] = total
-        
-        print(f"\n📦 Created {len(chunks)} chunks from document")
-        for chunk in chunks:
-            print(f"   Chunk {chunk['chunk_index']}/{chunk['total_chunks']}: {chunk['tokens']} tokens")
-        
         return chunks
 
@@ -1,9 +1,35 @@
 """
 PDF Coordinate Extractor - Locates text positions in PDF for highlighting
 """
+from itertools import repeat
 import pdfplumber
+import numpy as np
 from typing import List, Dict, Optional, Tuple
 import re
+from process_pool import POOL_WORKERS, get_process_pool, split_evenly
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+_WS_RE = re.compile(r'\s+')
+# Bound method alias - skips the attribute lookup on every _clean_text call
+_WS_SUB = _WS_RE.sub
+
+# Warming fewer pages than this is done serially - pool startup costs more
+PARALLEL_MIN_PAGES = 4
+
+
+def _extract_pages_data(pdf_path: str, page_nums: List[int]) -> List[Tuple[str, List[Dict]]]:
+    """Extract (text, words) for a run of pages (runs in a worker - opens the PDF once per chunk)"""
+    results = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_num in page_nums:
+            page = pdf.pages[page_num - 1]
+            results.append((page.extract_text() or '', page.extract_words(x_tolerance=3, y_tolerance=3)))
+    return results
 
 
 class PDFCoordinateExtractor:
@@ -18,8 +44,126 @@ class PDFCoordinateExtractor:
         """
         self.pdf_path = pdf_path
         self.pdf = pdfplumber.open(pdf_path)
+        
+        # Per-page caches - pdfplumber parsing dominates the cost of each lookup
+        self._text_cache: Dict[int, str] = {}
+        self._clean_text_cache: Dict[int, str] = {}
+        self._words_cache: Dict[Tuple[int, int, int], List[Dict]] = {}
+        self._word_boxes_cache: Dict[int, np.ndarray] = {}
+        self._word_index_cache: Dict[int, Tuple[str, np.ndarray]] = {}
         print(f"📍 Loaded PDF for coordinate extraction: {pdf_path}")
     
+    def _get_page_text(self, page_num: int) -> str:
+        """Get (cached) extracted text for a page (1-indexed)"""
+        text = self._text_cache.get(page_num)
+        if text is None:
+            text = self.pdf.pages[page_num - 1].extract_text() or ''
+            self._text_cache[page_num] = text
+        return text
+    
+    def _get_clean_page_text(self, page_num: int) -> str:
+        """Get (cached) cleaned text for a page (1-indexed)"""
+        clean = self._clean_text_cache.get(page_num)
+        if clean is None:
+            clean = self._clean_text(self._get_page_text(page_num))
+            self._clean_text_cache[page_num] = clean
+        return clean
+    
+    def _get_page_words(self, page_num: int, x_tolerance: int = 3, y_tolerance: int = 3) -> List[Dict]:
+        """Get (cached) words with bounding boxes for a page (1-indexed)"""
+        key = (page_num, x_tolerance, y_tolerance)
+        words = self._words_cache.get(key)
+        if words is None:
+            words = self.pdf.pages[page_num - 1].extract_words(x_tolerance=x_tolerance, y_tolerance=y_tolerance)
+            self._words_cache[key] = words
+        return words
+    
+    def _get_page_word_boxes(self, page_num: int) -> np.ndarray:
+        """Get (cached) (N, 4) array of word boxes [x0, top, x1, bottom] for a page (1-indexed)"""
+        boxes = self._word_boxes_cache.get(page_num)
+        if boxes is None:
+            words = self._get_page_words(page_num)
+            boxes = np.array([(w['x0'], w['top'], w['x1'], w['bottom']) for w in words], dtype=np.float64).reshape(-1, 4)
+            self._word_boxes_cache[page_num] = boxes
+        return boxes
+    
+    def _get_page_word_index(self, page_num: int) -> Tuple[str, np.ndarray]:
+        """
+        Get (cached) cleaned word stream for a page (1-indexed)
+        
+        Returns:
+            Tuple of (cleaned words joined by single spaces, start offset of each word in it)
+        """
+        index = self._word_index_cache.get(page_num)
+        if index is None:
+            clean_words = [self._clean_text(w['text']) for w in self._get_page_words(page_num)]
+            lengths = np.fromiter((len(w) + 1 for w in clean_words), dtype=np.int64, count=len(clean_words))
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(clean_words) else lengths
+            index = (' '.join(clean_words), starts)
+            self._word_index_cache[page_num] = index
+        return index
+    
+    def _find_word_range(self, page_num: int, clean_search_words: List[str]) -> Optional[List[int]]:
+        """Indices of the page words exactly spanning the search words, or None if not found"""
+        joined, starts = self._get_page_word_index(page_num)
+        snippet = ' '.join(clean_search_words)
+        hit = joined.find(snippet) if snippet else -1
+        if hit < 0:
+            return None
+        first = int(np.searchsorted(starts, hit, side='right')) - 1
+        last = int(np.searchsorted(starts, hit + len(snippet) - 1, side='right')) - 1
+        return list(range(first, last + 1))
+    
+    def _match_words_fuzzy(self, words: List[Dict], clean_search_words: List[str]) -> List[int]:
+        """Longest run of page words that each overlap some search word (sliding window)"""
+        best_match_positions = []
+        current_match = []
+        
+        for i, word in enumerate(words):
+            word_text = self._clean_text(word['text'])
+            
+            # Check if this word matches any of our search words
+            for search_word in clean_search_words:
+                if search_word and word_text and (search_word in word_text or word_text in search_word):
+                    current_match.append(i)
+                    break
+            else:
+                # No match, check if we have a good sequence
+                if len(current_match) > len(best_match_positions):
+                    best_match_positions = current_match
+                current_match = []
+            
+            # Stop if we have enough words
+            if len(current_match) >= min(len(clean_search_words), 15):
+                best_match_positions = current_match
+                break
+        
+        # Final check
+        if len(current_match) > len(best_match_positions):
+            best_match_positions = current_match
+        return best_match_positions
+    
+    def warmup(self, pages: Optional[List[int]] = None):
+        """
+        Pre-fill the per-page caches in one sweep
+        
+        Args:
+            pages: Page numbers (1-indexed) to warm, or None for all pages
+        """
+        pages = list(pages or range(1, len(self.pdf.pages) + 1))
+        missing = [p for p in pages if p not in self._text_cache or (p, 3, 3) not in self._words_cache]
+        if len(missing) >= PARALLEL_MIN_PAGES:
+            # Text and word extraction are CPU bound per page - spread them across cores
+            chunks = split_evenly(missing, POOL_WORKERS)
+            results = get_process_pool().map(_extract_pages_data, repeat(self.pdf_path), chunks)
+            for page_nums, chunk in zip(chunks, results):
+                for page_num, (text, words) in zip(page_nums, chunk):
+                    self._text_cache.setdefault(page_num, text)
+                    self._words_cache.setdefault((page_num, 3, 3), words)
+        for page_num in pages:
+            self._get_clean_page_text(page_num)
+            self._get_page_word_index(page_num)
+    
     def find_text_coordinates(self, search_text: str, page_number: Optional[int] = None) -> Optional[Dict]:
         """
         Find coordinates of text in PDF
@@ -37,39 +181,88 @@ class PDFCoordinateExtractor:
         # Determine which pages to search
         pages_to_search = [page_number] if page_number else range(1, len(self.pdf.pages) + 1)
         
-        # Try multiple search strategies with different snippet lengths
-        snippet_lengths = [200, 150, 100, 75, 50]
+        # Snippets of 200/150/100/75/50 chars are all prefixes of the search text,
+        # so a page contains one of them iff it contains the shortest. Probe only
+        # that one: a miss rules out every longer snippet with a single scan.
+        search_snippet = clean_search[:50]
         
-        for page_num in pages_to_search:
-            page = self.pdf.pages[page_num - 1]  # Convert to 0-indexed
-            page_text = page.extract_text()
-            
-            if not page_text:
-                continue
-            
-            clean_page_text = self._clean_text(page_text)
-            
-            # Try different snippet lengths to find a match
-            for snippet_len in snippet_lengths:
-                search_snippet = clean_search[:snippet_len]
-                
-                if len(search_snippet) < 20:  # Too short, skip
-                    continue
+        if len(search_snippet) >= 20:  # Shorter snippets are too ambiguous to match
+            for page_num in pages_to_search:
+                clean_page_text = self._get_clean_page_text(page_num)
                 
                 if search_snippet in clean_page_text:
                     # Found the text, now get coordinates
+                    page = self.pdf.pages[page_num - 1]  # Convert to 0-indexed
                     coords = self._extract_coordinates(page, search_text, page_num)
                     if coords:
                         return coords
-                    break  # If extraction failed, try next page
         
         # If exact match not found, return estimated coordinates
-        # Get page for dimensions
-        fallback_page_num = page_number or 1
-        if fallback_page_num <= len(self.pdf.pages):
-            fallback_page = self.pdf.pages[fallback_page_num - 1]
-            return self._create_default_coordinates(fallback_page_num, fallback_page.height, fallback_page.width)
-        return self._create_default_coordinates(fallback_page_num)
+        return self._fallback_coordinates(page_number or 1)
+    
+    def find_all_coordinates(self, highlights: List[Dict]) -> Dict:
+        """
+        Find coordinates for many highlights at once
+        
+        With pyahocorasick installed, every highlight's snippet is located in a
+        single pass over each page instead of one scan per highlight. Without
+        it, this falls back to calling find_text_coordinates per highlight.
+        
+        Args:
+            highlights: List of dicts with 'id' and 'text'
+            
+        Returns:
+            Dictionary mapping highlight id to position data
+        """
+        if not AHOCORASICK_AVAILABLE:
+            return {h['id']: self.find_text_coordinates(h['text']) for h in highlights}
+        
+        results = {}
+        pending = {}  # snippet -> highlights still looking for a page
+        for highlight in highlights:
+            # Same 50-char anchor that find_text_coordinates probes
+            snippet = self._clean_text(highlight['text'])[:50]
+            if len(snippet) < 20:  # Too short, can never match
+                results[highlight['id']] = self._fallback_coordinates(1)
+            else:
+                pending.setdefault(snippet, []).append(highlight)
+        
+        for page_num in range(1, len(self.pdf.pages) + 1):
+            if not pending:
+                break
+            
+            clean_page_text = self._get_clean_page_text(page_num)
+            if not clean_page_text:
+                continue
+            
+            automaton = ahocorasick.Automaton()
+            for snippet in pending:
+                automaton.add_word(snippet, snippet)
+            automaton.make_automaton()
+            
+            page = self.pdf.pages[page_num - 1]
+            retry = {}  # Snippet found but no word boxes matched - keep looking on later pages
+            for _, snippet in automaton.iter(clean_page_text):
+                for highlight in pending.pop(snippet, ()):
+                    coords = self._extract_coordinates(page, highlight['text'], page_num)
+                    if coords:
+                        results[highlight['id']] = coords
+                    else:
+                        retry.setdefault(snippet, []).append(highlight)
+            pending.update(retry)
+        
+        for unmatched in pending.values():
+            for highlight in unmatched:
+                results[highlight['id']] = self._fallback_coordinates(1)
+        
+        return results
+    
+    def _fallback_coordinates(self, page_num: int) -> Dict:
+        """Estimated coordinates on a page, using its real dimensions when available"""
+        if page_num <= len(self.pdf.pages):
+            fallback_page = self.pdf.pages[page_num - 1]
+            return self._create_default_coordinates(page_num, fallback_page.height, fallback_page.width)
+        return self._create_default_coordinates(page_num)
     
     def _extract_coordinates(self, page, text: str, page_num: int) -> Optional[Dict]:
         """
@@ -89,7 +282,7 @@ class PDFCoordinateExtractor:
             page_width = page.width
             
             # Get all words with their bounding boxes
-            words = page.extract_words(x_tolerance=3, y_tolerance=3)
+            words = self._get_page_words(page_num)
             
             if not words:
                 return self._create_default_coordinates(page_num, page_height, page_width)
@@ -98,44 +291,22 @@ class PDFCoordinateExtractor:
             search_words = text.split()[:30]  # Use first 30 words for better matching
             clean_search_words = [self._clean_text(sw) for sw in search_words if sw.strip()]
             
-            # Find matching sequence using sliding window
-            word_positions = []
-            best_match_positions = []
-            current_match = []
-            
-            for i, word in enumerate(words):
-                word_text = self._clean_text(word['text'])
-                
-                # Check if this word matches any of our search words
-                for search_word in clean_search_words:
-                    if search_word and word_text and (search_word in word_text or word_text in search_word):
-                        current_match.append(word)
-                        break
-                else:
-                    # No match, check if we have a good sequence
-                    if len(current_match) > len(best_match_positions):
-                        best_match_positions = current_match
-                    current_match = []
-                
-                # Stop if we have enough words
-                if len(current_match) >= min(len(clean_search_words), 15):
-                    best_match_positions = current_match
-                    break
-            
-            # Final check
-            if len(current_match) > len(best_match_positions):
-                best_match_positions = current_match
-            
-            word_positions = best_match_positions if best_match_positions else []
+            # Exact match of the leading search words in the page's word stream maps
+            # straight to a word range; fall back to the fuzzy sliding window otherwise
+            best_match_positions = self._find_word_range(page_num, clean_search_words[:15])
+            if best_match_positions is None:
+                best_match_positions = self._match_words_fuzzy(words, clean_search_words)
             
-            if not word_positions:
+            if not best_match_positions:
                 return self._create_default_coordinates(page_num, page_height, page_width)
             
-            # Calculate bounding box from word positions (pdfplumber coordinates)
-            x0 = min(w['x0'] for w in word_positions)
-            y0_pdf = min(w['top'] for w in word_positions)
-            x1 = max(w['x1'] for w in word_positions)
-            y1_pdf = max(w['bottom'] for w in word_positions)
+            # Bounding box over the matched words' [x0, top, x1, bottom] rows
+            idx = np.asarray(best_match_positions)
+            boxes = self._get_page_word_boxes(page_num)[idx]
+            x0 = float(boxes[:, 0].min())
+            y0_pdf = float(boxes[:, 1].min())
+            x1 = float(boxes[:, 2].max())
+            y1_pdf = float(boxes[:, 3].max())
             
             # Transform to PDF.js/react-pdf-highlighter coordinate system
             # In PDF.js, Y-axis origin is at BOTTOM-LEFT (increases upward)
@@ -144,22 +315,13 @@ class PDFCoordinateExtractor:
             y0 = round(page_height - y1_pdf, 2)  # Bottom edge in PDF.js
             y1 = round(page_height - y0_pdf, 2)  # Top edge in PDF.js
             
-            # Create rects for multi-line text (group by approximate y position)
-            rects = []
-            current_line = []
-            last_y = None
-            
-            for word in word_positions:
-                if last_y is None or abs(word['top'] - last_y) < 5:  # Same line
-                    current_line.append(word)
-                else:
-                    if current_line:
-                        rects.append(self._create_rect_from_words(current_line, page_num, page_height))
-                    current_line = [word]
-                last_y = word['top']
-            
-            if current_line:
-                rects.append(self._create_rect_from_words(current_line, page_num, page_height))
+            # Create rects for multi-line text - a new line starts wherever the
+            # top edge jumps by 5pt or more from the previous word
+            line_breaks = np.flatnonzero(np.abs(np.diff(boxes[:, 1])) >= 5) + 1
+            rects = [
+                self._create_rect_from_boxes(line_boxes, page_num, page_height)
+                for line_boxes in np.split(boxes, line_breaks)
+            ]
             
             return {
                 "boundingRect": {
@@ -194,22 +356,22 @@ class PDFCoordinateExtractor:
             except:
                 return self._create_default_coordinates(page_num)
     
-    def _create_rect_from_words(self, words: List[Dict], page_num: int, page_height: float) -> Dict:
+    def _create_rect_from_boxes(self, boxes: np.ndarray, page_num: int, page_height: float) -> Dict:
         """
-        Create a rectangle from a list of words
+        Create a rectangle from an (N, 4) array of [x0, top, x1, bottom] word boxes
         
         Args:
-            words: List of word dictionaries with positions
+            boxes: Word boxes on a single line
             page_num: Page number (1-indexed)
             page_height: Height of the page for coordinate transformation
             
         Returns:
             Rectangle in PDF.js/react-pdf-highlighter coordinate system
         """
-        x0 = min(w['x0'] for w in words)
-        x1 = max(w['x1'] for w in words)
-        y0_pdf = min(w['top'] for w in words)
-        y1_pdf = max(w['bottom'] for w in words)
+        x0 = float(boxes[:, 0].min())
+        y0_pdf = float(boxes[:, 1].min())
+        x1 = float(boxes[:, 2].max())
+        y1_pdf = float(boxes[:, 3].max())
         
         # Transform to PDF.js coordinate system
         y0 = round(page_height - y1_pdf, 2)
@@ -287,9 +449,7 @@ class PDFCoordinateExtractor:
     def _clean_text(self, text: str) -> str:
         """Clean text for comparison"""
         # Remove extra whitespace and normalize
-        text = re.sub(r'\s+', ' ', text)
-        text = text.strip().lower()
-        return text
+        return _WS_SUB(' ', text).strip().lower()
     
     def close(self):
         """Close the PDF file"""
@@ -1,36 +1,84 @@
 """
 PDF text extraction module
 """
+from itertools import repeat
 import PyPDF2
+from process_pool import POOL_WORKERS, get_process_pool, split_evenly
+
+try:
+    import pypdfium2
+    PYPDFIUM2_AVAILABLE = True
+except ImportError:
+    PYPDFIUM2_AVAILABLE = False
+
+# Documents with fewer pages are extracted serially - pool startup costs more
+PARALLEL_MIN_PAGES = 4
+
+
+def _extract_pages(pdf_path: str, page_indices: list) -> list:
+    """Extract a run of pages' text (runs in a worker - parses the PDF once per chunk)"""
+    with open(pdf_path, 'rb') as file:
+        pages = PyPDF2.PdfReader(file).pages
+        return [pages[i].extract_text() or '' for i in page_indices]
 
 
 class PDFExtractor:
     """Extract text from PDF files"""
     
     @staticmethod
-    def extract_text(pdf_path: str) -> str:
+    def extract_text(pdf_path: str, verbose: bool = False) -> str:
         """
         Extract text from a PDF file
         
         Args:
             pdf_path: Path to PDF file
+            verbose: Print per-page progress (slow on a TTY for large documents)
             
         Returns:
             Extracted text
         """
         print(f"📄 Extracting text from: {pdf_path}")
         
-        text = ""
         with open(pdf_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
             total_pages = len(pdf_reader.pages)
             
             print(f"   Found {total_pages} pages")
             
-            for page_num, page in enumerate(pdf_reader.pages, 1):
-                print(f"   Processing page {page_num}/{total_pages}...", end='\r')
-                text += page.extract_text() + "\n\n"
+            if total_pages < PARALLEL_MIN_PAGES:
+                pieces = [None] * total_pages
+                for i, page in enumerate(pdf_reader.pages):
+                    if verbose:
+                        print(f"   Processing page {i + 1}/{total_pages}...", end='\r')
+                    pieces[i] = page.extract_text() or ''
+        
+        if total_pages >= PARALLEL_MIN_PAGES:
+            # PyPDF2 extraction is pure-Python and CPU bound - spread pages across cores
+            chunks = split_evenly(list(range(total_pages)), POOL_WORKERS)
+            if verbose:
+                print(f"   Processing {total_pages} pages with {len(chunks)} workers...")
+            results = get_process_pool().map(_extract_pages, repeat(pdf_path), chunks)
+            pieces = [text for chunk in results for text in chunk]
         
+        text = "\n\n".join(pieces).strip()
         print(f"   ✓ Extracted {len(text)} characters")
-        return text.strip()
-
+        return text
+    
+    @staticmethod
+    def get_page_count(pdf_path: str) -> int:
+        """
+        Count a PDF's pages without parsing them
+        
+        pdfium only reads the page tree; PyPDF2 is the fallback.
+        """
+        if PYPDFIUM2_AVAILABLE:
+            try:
+                pdf = pypdfium2.PdfDocument(pdf_path)
+                try:
+                    return len(pdf)
+                finally:
+                    pdf.close()
+            except pypdfium2.PdfiumError:
+                pass
+        with open(pdf_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
@@ -0,0 +1,43 @@
+"""
+Shared worker pool for CPU-bound PDF parsing
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+POOL_WORKERS = os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Return the process-wide worker pool, starting it on first use
+
+    Workers come from a forkserver (spawn where that is unavailable) rather
+    than fork, so they never inherit locks held by the server's gRPC,
+    Snowflake or uvicorn threads.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+            )
+        return _pool
+
+
+def split_evenly(items: list, parts: int) -> list:
+    """Split items into at most `parts` contiguous, non-empty chunks"""
+    parts = max(1, min(parts, len(items)))
+    size, extra = divmod(len(items), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
@@ -3,14 +3,47 @@ RAG Analyzer - Handles Snowflake vector search and Gemini AI analysis
 """
 import snowflake.connector
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import os
 import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
 import numpy as np
 import re
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Callable, TypedDict
 from datetime import datetime
 
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import hnswlib
+    HNSWLIB_AVAILABLE = True
+except ImportError:
+    HNSWLIB_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Load environment variables
 load_dotenv()
 
@@ -18,9 +51,606 @@ load_dotenv()
 genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 
 
+# First markdown code fence in a model response - an unclosed fence runs to the end
+_FENCE_RE = re.compile(r'```[\w-]*[ \t]*\n?(.*?)(?:```|\Z)', re.S)
+
+
+def _strip_code_fence(response_text: str) -> str:
+    """Remove a markdown code fence (```json ... ```) around a model response"""
+    match = _FENCE_RE.search(response_text)
+    return (match.group(1) if match else response_text).strip()
+
+
+def _loads(response_text: str):
+    """Parse JSON with orjson when available, falling back to the more lenient stdlib parser"""
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.loads(response_text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(response_text)
+
+
+class _IllegalClause(TypedDict):
+    clause: str
+    violation: str
+    explanation: str
+    severity: str
+    potential_recovery: str
+    recovery_calculation: str
+
+
+class _RiskyTerm(TypedDict):
+    term: str
+    risk: str
+    explanation: str
+    severity: str
+
+
+class _FavorableClause(TypedDict):
+    clause: str
+    benefit: str
+    relevant_law: str
+
+
+class _Concern(TypedDict):
+    issue: str
+    recommendation: str
+
+
+class _ChunkAnalysis(TypedDict):
+    illegal_clauses: List[_IllegalClause]
+    risky_terms: List[_RiskyTerm]
+    favorable_clauses: List[_FavorableClause]
+    concerns: List[_Concern]
+
+
+class _IndexedChunkAnalysis(_ChunkAnalysis):
+    chunk_index: int
+
+
+class _BatchAnalysis(TypedDict):
+    results: List[_IndexedChunkAnalysis]
+
+
+# JSON mode - Gemini returns bare JSON matching _ChunkAnalysis (no fences to strip)
+ANALYSIS_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': _ChunkAnalysis,
+}
+
+METADATA_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+}
+
+BATCH_ANALYSIS_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': _BatchAnalysis,
+}
+
+
+# Per-chunk JSON structure and extraction guidelines shared by the analysis prompts
+# (str.format templates - literal JSON braces are doubled)
+_ANALYSIS_JSON_STRUCTURE = """{{
+    "illegal_clauses": [
+        {{
+            "clause": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
+            "violation": "which law/statute it violates",
+            "explanation": "why this is illegal",
+            "severity": "high/critical",
+            "potential_recovery": "estimated dollar amount tenant could recover (e.g., $5000)",
+            "recovery_calculation": "detailed explanation of how this amount is calculated under MA law, citing specific statutory remedies"
+        }}
+    ],
+    "risky_terms": [
+        {{
+            "term": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
+            "risk": "potential legal issue",
+            "explanation": "why this could be problematic",
+            "severity": "medium/high"
+        }}
+    ],
+    "favorable_clauses": [
+        {{
+            "clause": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
+            "benefit": "how this protects the tenant",
+            "relevant_law": "supporting statute if any"
+        }}
+    ],
+    "concerns": [
+        {{
+            "issue": "description of concern",
+            "recommendation": "what should be done"
+        }}
+    ]
+}}"""
+
+_ANALYSIS_GUIDELINES = """CRITICAL INSTRUCTIONS FOR TEXT EXTRACTION:
+- For the "clause", "term", and "clause" fields, you MUST copy the EXACT text as it appears in the lease above
+- Do NOT paraphrase, summarize, or reword the text in any way
+- Copy the text VERBATIM, character by character, including all punctuation, capitalization, and spacing
+- Include complete sentences or paragraphs that contain the problematic language
+- The text you provide will be used to locate the clause in the PDF, so precision is essential
+
+Be thorough and cite specific statutes. If a clause is found in the lease that violates MA law, mark it as illegal.
+
+Common violations and their penalties under Massachusetts law:
+- Security deposit violations (Chapter 186, §15B): Up to 3x the deposit amount plus attorney's fees and costs
+- Chapter 93A consumer protection violations: Double or triple damages (actual damages × 2 or × 3)
+- Illegal exculpatory clauses (Chapter 186, §15): Actual damages plus statutory penalties
+- Attorney fee violations (Chapter 186, §20): Attorney's fees if tenant prevails
+- Waiver of tenant rights: Actual damages and potential punitive damages
+- Improper security deposit handling: $1,000-$5,000 typical range
+- Prohibited lease terms (Chapter 186, §15B): Actual damages plus statutory remedies
+
+For each illegal clause, estimate the potential recovery based on:
+1. The specific statute violated and its remedies
+2. Typical damages awarded in MA courts for similar violations
+3. Whether multiple damages (2x, 3x) apply under Chapter 93A
+4. Attorney's fees and costs if applicable
+
+Return ONLY valid JSON, no additional text."""
+
+# Chunk analysis prompt - filled with str.format
+_ANALYSIS_PROMPT_TEMPLATE = """You are a legal expert specializing in Massachusetts tenant rights and housing law.
+
+Analyze the following lease agreement clause against Massachusetts General Laws (Chapter 186 - Estates for Years and at Will, and Chapter 93A - Consumer Protection).
+
+LEASE AGREEMENT CLAUSE (Chunk {chunk_index}/{total_chunks}):
+{clause}
+
+RELEVANT MASSACHUSETTS LAWS:
+{context}
+
+Provide a detailed analysis in JSON format with the following structure:
+""" + _ANALYSIS_JSON_STRUCTURE + "\n\n" + _ANALYSIS_GUIDELINES
+
+# Several chunks in one prompt - the law context and instructions are sent once
+_BATCH_ANALYSIS_PROMPT_TEMPLATE = """You are a legal expert specializing in Massachusetts tenant rights and housing law.
+
+Analyze EACH of the following lease agreement clauses separately against Massachusetts General Laws (Chapter 186 - Estates for Years and at Will, and Chapter 93A - Consumer Protection).
+
+{clauses}
+
+RELEVANT MASSACHUSETTS LAWS (shared by all clauses above - each clause heading lists the labels of the laws retrieved for it):
+{context}
+
+Provide a detailed analysis in JSON format as {{"results": [...]}} with one entry per clause. Each entry has a "chunk_index" field (the chunk number from the clause heading) plus the following structure, describing that clause only:
+""" + _ANALYSIS_JSON_STRUCTURE + "\n\n" + _ANALYSIS_GUIDELINES
+
+
+# Dollar amount in a recovery estimate, e.g. "$5,000" or "2500"
+_MONEY_RE = re.compile(r'\$?(\d{1,3}(?:,?\d{3})*)')
+
+# Recovery estimates by violation type when Gemini gives no dollar amount - first match wins
+_RECOVERY_RULES = (
+    (re.compile(r'security deposit', re.I), 5000),
+    (re.compile(r'93a', re.I), 2500),
+)
+_DEFAULT_RECOVERY = 1000
+
+
+def _fallback_recovery(violation: str) -> int:
+    """Estimated recovery for a violation without a parseable amount"""
+    for pattern, amount in _RECOVERY_RULES:
+        if pattern.search(violation):
+            return amount
+    return _DEFAULT_RECOVERY
+
+# Concurrent Gemini calls when analyzing the chunks of one lease
+ANALYSIS_CONCURRENCY = 8
+
+# Lease chunks sent per Gemini prompt - larger batches risk truncated JSON output
+ANALYSIS_BATCH_SIZE = int(os.getenv('ANALYSIS_BATCH_SIZE', '4'))
+
+# Transient Gemini errors (429 / 5xx) worth retrying with backoff
+GEMINI_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+)
+GEMINI_MAX_ATTEMPTS = 5
+GEMINI_MAX_BACKOFF = 30.0
+
+CHAT_GENERATION_CONFIG = {
+    'temperature': 0.7,  # Balance between creative and factual
+    'top_p': 0.95,
+    'top_k': 40,
+    'max_output_tokens': 1024,
+}
+
+
+def _call_gemini(model, prompt: str, label: str, generation_config: Dict = None):
+    """Call Gemini, backing off with full jitter on rate limits and server errors"""
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            return model.generate_content(prompt, generation_config=generation_config)
+        except GEMINI_RETRYABLE_ERRORS as e:
+            if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(0, min(GEMINI_MAX_BACKOFF, 2 ** attempt))
+            print(f"⚠️  Gemini busy ({e.__class__.__name__}), retrying {label} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# Placeholder highlight box used when a clause cannot be located in the PDF
+_DEFAULT_RECT = {"x1": 72, "y1": 200, "x2": 540, "y2": 250}
+_default_positions = {}
+
+# Chat models in order of preference
+CHAT_MODEL_NAMES = (
+    'gemini-1.5-flash',  # Fast and reliable
+    'gemini-1.5-pro',    # More capable
+    'gemini-pro',        # Stable fallback
+    'gemini-2.0-flash-exp',  # Experimental
+)
+
+# Chat models by name - built once per process instead of on every question
+_chat_models = {}
+
+# Last chat model that answered - tried first so later questions skip models known to fail
+_working_chat_model_name = None
+
+
+def _get_chat_model(model_name: str):
+    """Get the (cached) chat GenerativeModel for a model name"""
+    model = _chat_models.get(model_name)
+    if model is None:
+        model = genai.GenerativeModel(model_name, generation_config=CHAT_GENERATION_CONFIG)
+        _chat_models[model_name] = model
+    return model
+
+
+# Metadata extraction and chunk analysis model - holds no per-request state, so one per process
+ANALYSIS_MODEL_NAME = 'gemini-2.0-flash-exp'
+_analysis_model = genai.GenerativeModel(ANALYSIS_MODEL_NAME)
+
+
+EMBEDDING_MODEL = 'snowflake-arctic-embed-l-v2.0'
+
+# Number of query embeddings kept in memory - EMBED_TEXT_1024 is a paid round-trip.
+# Stored as float32 arrays (4 KB each) rather than lists of Python floats
+EMBEDDING_CACHE_SIZE = 10000
+
+
+class _LRUCache:
+    """Thread-safe LRU mapping shared by every RAGAnalyzer in the process"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_embedding_cache = _LRUCache(EMBEDDING_CACHE_SIZE)
+
+# On-disk copy of the embedding cache so it survives restarts (set to '' to disable)
+EMBEDDING_STORE_PATH = os.getenv(
+    'EMBEDDING_STORE_PATH', os.path.join(os.path.dirname(__file__), '..', 'data', 'embeddings.sqlite')
+)
+
+
+class _EmbeddingStore:
+    """SQLite table of float32 embeddings keyed by _embedding_key digest"""
+    
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB)")
+        self._lock = threading.Lock()
+    
+    def get(self, key: bytes):
+        with self._lock:
+            row = self._conn.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+    
+    def put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                [(key, embedding.tobytes()) for key, embedding in items]
+            )
+
+
+try:
+    _embedding_store = _EmbeddingStore(EMBEDDING_STORE_PATH) if EMBEDDING_STORE_PATH else None
+except sqlite3.Error as e:
+    print(f"⚠️  Embedding store unavailable, caching in memory only: {e}")
+    _embedding_store = None
+
+
+def _cached_embedding(key: bytes):
+    """Look up an embedding in memory, then on disk"""
+    embedding = _embedding_cache.get(key)
+    if embedding is None and _embedding_store is not None:
+        embedding = _embedding_store.get(key)
+        if embedding is not None:
+            _embedding_cache.put(key, embedding)
+    return embedding
+
+
+def _cache_embeddings(items):
+    """Store (key, float32 embedding) pairs in memory and on disk"""
+    items = list(items)
+    for key, embedding in items:
+        _embedding_cache.put(key, embedding)
+    if _embedding_store is not None:
+        try:
+            _embedding_store.put_many(items)
+        except sqlite3.Error as e:
+            print(f"⚠️  Could not persist embeddings: {e}")
+
+# Rank laws against an in-memory copy of the corpus instead of inside Snowflake
+LAW_SEARCH_LOCAL = os.getenv('LAW_SEARCH_LOCAL', '').lower() in ('1', 'true', 'yes')
+
+# Rank locally through an approximate HNSW index instead of exact scoring (needs
+# hnswlib). The index is persisted and rebuilt when the corpus changes
+LAW_SEARCH_HNSW = os.getenv('LAW_SEARCH_HNSW', '').lower() in ('1', 'true', 'yes')
+LAW_INDEX_PATH = os.getenv(
+    'LAW_INDEX_PATH', os.path.join(os.path.dirname(__file__), '..', 'data', 'laws.hnsw')
+)
+
+# Pre-select local ranking candidates by Hamming distance over sign bits (1 bit per
+# dimension), then re-rank BINARY_RERANK_FACTOR * top_k of them exactly. Check
+# RAGAnalyzer.binary_prefilter_recall on the corpus before enabling
+LAW_SEARCH_BINARY = os.getenv('LAW_SEARCH_BINARY', '').lower() in ('1', 'true', 'yes')
+BINARY_RERANK_FACTOR = 4
+
+# Ranked law results per (text, top_k) - repeated boilerplate chunks and questions
+LAW_SEARCH_CACHE_SIZE = 1024
+_law_search_cache = _LRUCache(LAW_SEARCH_CACHE_SIZE)
+
+# Joined law context text per tuple of law ids, for analysis prompts
+_law_context_cache = _LRUCache(256)
+
+# Reuse a previous chat answer when a general question is this similar to one already asked
+CHAT_CACHE_THRESHOLD = float(os.getenv('CHAT_CACHE_THRESHOLD', '0.92'))
+# Cached answers older than this are ignored and pruned, which also bounds the
+# table every lookup scans
+CHAT_CACHE_TTL_HOURS = int(os.getenv('CHAT_CACHE_TTL_HOURS', '168'))
+CHAT_CACHE_PRUNE_INTERVAL = 3600  # seconds between prunes per process
+_chat_cache_ready = False
+_chat_cache_pruned_at = None
+
+
+def _embedding_key(text: str) -> bytes:
+    """Cache key for a text's embedding - a digest keeps long chunk texts out of memory"""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode('utf-8')).digest()
+
+
+# int8 copy of text_embedding, written by RAGAnalyzer.build_quantized_embeddings
+QUANTIZED_EMBEDDING_COLUMN = 'text_embedding_i8'
+
+# Set once RAGAnalyzer.normalize_law_embeddings has stored unit-length law embeddings -
+# server-side search then ranks with a plain inner product instead of cosine
+LAW_EMBEDDINGS_NORMALIZED = os.getenv('LAW_EMBEDDINGS_NORMALIZED', '').lower() in ('1', 'true', 'yes')
+
+# Similarity of law row d against inline query embedding q (q.norm is its length) -
+# with unit law rows, dividing by the query norm once turns the inner product into cosine
+if LAW_EMBEDDINGS_NORMALIZED:
+    _QUERY_SIMILARITY_SQL = 'VECTOR_INNER_PRODUCT(d.text_embedding, q.embedding) / q.norm'
+else:
+    _QUERY_SIMILARITY_SQL = 'VECTOR_COSINE_SIMILARITY(d.text_embedding, q.embedding)'
+
+
+def _arrow_vectors(column) -> np.ndarray:
+    """Float32 (N, D) matrix from an Arrow column of embedding lists"""
+    column = column.combine_chunks()
+    if not hasattr(column, 'flatten'):  # Not a list column - decode row by row
+        return _stack_float32(column.to_pylist())
+    # Copied once into a writable array - Arrow buffers are read-only and the
+    # matrix is normalized in place
+    values = np.array(column.flatten().to_numpy(zero_copy_only=False), dtype=np.float32)
+    return values.reshape(len(column), -1)
+
+
+def _normalize_rows(matrix: np.ndarray, in_place: bool = False) -> np.ndarray:
+    """Scale each row of an (N, D) matrix to unit length (all-zero rows stay zero)"""
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+    norms[norms == 0] = 1.0
+    if in_place:
+        matrix /= norms[:, None]
+        return matrix
+    return matrix / norms[:, None]
+
+
+def _stack_float32(vectors) -> np.ndarray:
+    """Copy a sequence of equal-length vectors into one preallocated float32 matrix"""
+    vectors = list(vectors)
+    matrix = np.empty((len(vectors), len(vectors[0])), dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        matrix[i] = vector
+    return matrix
+
+
+def _drop_zero_rows(rows: list, matrix: np.ndarray):
+    """Drop corpus rows whose embedding is ~0 - they have no direction to compare against"""
+    keep = np.abs(matrix).max(axis=1) > 1e-12 if len(matrix) else np.ones(0, dtype=bool)
+    if keep.all():
+        return rows, matrix
+    print(f"⚠️  Skipping {int((~keep).sum())} law embeddings with zero norm")
+    return [row for row, kept in zip(rows, keep) if kept], matrix[keep]
+
+
+def _quantize_unit(unit_vectors: np.ndarray) -> np.ndarray:
+    """Quantize unit-length vectors to int8 with a fixed scale of 127"""
+    return np.clip(np.rint(unit_vectors * 127), -127, 127).astype(np.int8)
+
+
+def _law_similarities(law_embeddings: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of a query against a law matrix from _fetch_law_embeddings"""
+    if law_embeddings.dtype != np.int8:
+        return _unit_similarities(law_embeddings, query)
+    
+    query_unit = _normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))
+    if SIMSIMD_AVAILABLE:
+        # int8 cosine kernels (VNNI/dot-product instructions where supported)
+        distances = simsimd.cdist(_quantize_unit(query_unit), law_embeddings, metric='cosine')
+        return 1.0 - np.asarray(distances).ravel()
+    if NUMBA_AVAILABLE:
+        return _int8_row_cosines(law_embeddings, query_unit.ravel())
+    return _unit_similarities(_normalize_rows(law_embeddings.astype(np.float32)), query_unit.ravel())
+
+
+def _load_or_build_law_index(law_embeddings: np.ndarray):
+    """
+    Get an HNSW index over the law corpus for O(log N) queries
+    
+    The saved index at LAW_INDEX_PATH is reused when its digest matches the
+    corpus; otherwise a new one is built and saved for the next start.
+    """
+    if law_embeddings.dtype == np.int8:
+        law_embeddings = _normalize_rows(law_embeddings.astype(np.float32))
+    digest = hashlib.sha256(law_embeddings.tobytes()).hexdigest()
+    digest_path = LAW_INDEX_PATH + '.sha256'
+    
+    index = hnswlib.Index(space='cosine', dim=law_embeddings.shape[1])
+    try:
+        with open(digest_path, 'r') as f:
+            saved = f.read().strip() == digest
+    except OSError:
+        saved = False
+    
+    if saved:
+        try:
+            index.load_index(LAW_INDEX_PATH, max_elements=len(law_embeddings))
+            print(f"✓ Loaded law index from {LAW_INDEX_PATH}")
+            return index
+        except Exception as e:
+            print(f"⚠️  Could not load law index, rebuilding: {e}")
+            index = hnswlib.Index(space='cosine', dim=law_embeddings.shape[1])
+    
+    index.init_index(max_elements=len(law_embeddings), M=16, ef_construction=200)
+    index.add_items(law_embeddings, np.arange(len(law_embeddings)))
+    try:
+        index.save_index(LAW_INDEX_PATH)
+        with open(digest_path, 'w') as f:
+            f.write(digest)
+    except OSError as e:
+        print(f"⚠️  Could not save law index: {e}")
+    print(f"✓ Built law index over {len(law_embeddings)} embeddings")
+    return index
+
+
+# Set bits per byte value, for numpy versions without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _sign_bits(vectors: np.ndarray) -> np.ndarray:
+    """Pack the sign of every dimension into bits - 128 bytes for a 1024-d vector"""
+    return np.packbits(vectors > 0, axis=-1)
+
+
+def _binary_candidates(law_bits: np.ndarray, query: np.ndarray, n: int) -> np.ndarray:
+    """Indices of the n law rows closest to the query in Hamming distance (unordered)"""
+    differing = np.bitwise_xor(law_bits, _sign_bits(np.asarray(query)))
+    if hasattr(np, 'bitwise_count'):
+        distances = np.bitwise_count(differing).sum(axis=1, dtype=np.int32)
+    else:
+        distances = _POPCOUNT[differing].sum(axis=1, dtype=np.int32)
+    if n >= len(distances):
+        return np.arange(len(distances))
+    return np.argpartition(distances, n)[:n]
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, highest first - O(N) selection, then sorts only k"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+_prange = numba.prange if NUMBA_AVAILABLE else range
+
+
+def _row_dots(unit_embeddings: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Dot product of every row with the query
+    
+    Written as plain loops so numba can compile it into a parallel, vectorized
+    native kernel.
+    """
+    n_rows, dim = unit_embeddings.shape
+    scores = np.empty(n_rows, dtype=np.float32)
+    for i in _prange(n_rows):
+        acc = np.float32(0.0)
+        for j in range(dim):
+            acc += unit_embeddings[i, j] * query[j]
+        scores[i] = acc
+    return scores
+
+
+def _int8_row_cosines(codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of a unit query against raw int8 rows
+    
+    Each row's dot product and norm are accumulated in the same pass, so the
+    corpus is never widened to float or normalized up front.
+    """
+    n_rows, dim = codes.shape
+    scores = np.empty(n_rows, dtype=np.float32)
+    for i in _prange(n_rows):
+        dot = np.float32(0.0)
+        squares = 0
+        for j in range(dim):
+            code = np.int32(codes[i, j])
+            dot += np.float32(code) * query[j]
+            squares += code * code
+        scores[i] = dot / np.sqrt(np.float32(squares)) if squares else np.float32(0.0)
+    return scores
+
+
+if NUMBA_AVAILABLE:
+    _row_dots = numba.njit(cache=True, fastmath=True, parallel=True)(_row_dots)
+    _int8_row_cosines = numba.njit(cache=True, fastmath=True, parallel=True)(_int8_row_cosines)
+
+
+def _unit_similarities(unit_embeddings: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of a query against pre-normalized rows - a single dot product per row"""
+    query = np.asarray(query, dtype=unit_embeddings.dtype)
+    query = query / math.sqrt(float(np.vdot(query, query)))
+    if SIMSIMD_AVAILABLE:
+        return np.asarray(simsimd.cdist(query.reshape(1, -1), unit_embeddings, metric='dot')).ravel()
+    if NUMBA_AVAILABLE and unit_embeddings.dtype == np.float32:
+        return _row_dots(np.ascontiguousarray(unit_embeddings), query)
+    return unit_embeddings @ query
+
+
 class RAGAnalyzer:
     """RAG-based legal analysis using Snowflake and Gemini"""
     
+    # Law corpus for local ranking - static across a session, so shared by all instances
+    _law_rows = None
+    _law_embeddings = None
+    _law_index = None
+    _law_bits = None
+    _loaded_at = None
+    _corpus_lock = threading.Lock()
+    
     def __init__(self):
         """Initialize Snowflake connection"""
         self.conn = snowflake.connector.connect(
@@ -29,10 +659,16 @@ class RAGAnalyzer:
             password=os.getenv('SNOWFLAKE_PASSWORD'),
             warehouse=os.getenv('SNOWFLAKE_WAREHOUSE'),
             database=os.getenv('SNOWFLAKE_DATABASE'),
-            schema=os.getenv('SNOWFLAKE_SCHEMA')
+            schema=os.getenv('SNOWFLAKE_SCHEMA'),
+            # Long analyses keep the session alive; results come back as Arrow batches
+            client_session_keep_alive=True,
+            session_parameters={'PYTHON_CONNECTOR_QUERY_RESULT_FORMAT': 'arrow'}
         )
         self.cursor = self.conn.cursor()
         print("✓ Connected to Snowflake")
+        
+        # Shared by metadata extraction and every chunk analysis
+        self.gemini = _analysis_model
     
     def extract_metadata(self, lease_text: str, file_path: str = None) -> Dict:
         """
@@ -76,28 +712,18 @@ Be thorough and extract as much information as possible. If information is not f
 Return ONLY valid JSON, no additional text."""
 
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            response = model.generate_content(prompt)
-            
-            response_text = response.text.strip()
-            
-            # Remove markdown code blocks if present
-            if '```json' in response_text:
-                response_text = response_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in response_text:
-                response_text = response_text.split('```')[1].split('```')[0].strip()
+            response = _call_gemini(self.gemini, prompt, "metadata", METADATA_GENERATION_CONFIG)
             
-            metadata = json.loads(response_text)
+            # JSON mode returns bare JSON - the fence strip only guards against a stray wrapper
+            metadata = _loads(_strip_code_fence(response.text))
             
             # Get page count if file_path provided
             page_count = None
             file_size = None
             if file_path and os.path.exists(file_path):
                 try:
-                    import PyPDF2
-                    with open(file_path, 'rb') as f:
-                        pdf_reader = PyPDF2.PdfReader(f)
-                        page_count = len(pdf_reader.pages)
+                    from pdf_extraction import PDFExtractor
+                    page_count = PDFExtractor.get_page_count(file_path)
                     file_size = os.path.getsize(file_path)
                 except Exception as e:
                     print(f"⚠️  Could not read PDF metadata: {e}")
@@ -137,26 +763,385 @@ Return ONLY valid JSON, no additional text."""
             print(f"⚠️  Metadata extraction error: {e}")
             raise
     
-    def search_relevant_laws(self, text: str, top_k: int = 10) -> List[Dict]:
+    def search_relevant_laws(self, text: str, top_k: int = 10,
+                             embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """
         Search for relevant MA laws using vector similarity
         
         Args:
             text: Query text
             top_k: Number of results to return
+            embedding: Precomputed embedding of text (skips EMBED_TEXT_1024 and the embedding cache)
+            
+        Returns:
+            List of relevant law sections
+        """
+        key = (_embedding_key(text), top_k)
+        laws = _law_search_cache.get(key)
+        if laws is None:
+            text_embedding = embedding if embedding is not None else _cached_embedding(key[0])
+            if text_embedding is not None or LAW_SEARCH_LOCAL:
+                laws = self.search_relevant_laws_by_embedding(
+                    text_embedding if text_embedding is not None else self._embed_text(text), top_k
+                )
+            else:
+                laws = self._rank_with_query_embedding(text, top_k)
+            _law_search_cache.put(key, laws)
+        return list(laws)
+    
+    def search_relevant_laws_by_embedding(self, text_embedding: np.ndarray, top_k: int = 10) -> List[Dict]:
+        """
+        Search for relevant MA laws using an already computed query embedding
+        
+        Args:
+            text_embedding: 1024-d query embedding (e.g. a row of embed_texts)
+            top_k: Number of results to return
             
         Returns:
             List of relevant law sections
         """
-        # Get the embedding for the text
-        embedding_query = """
-        SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_1024('snowflake-arctic-embed-l-v2.0', %s) as embedding
+        text_embedding = np.asarray(text_embedding, dtype=np.float32)
+        key = (hashlib.sha256(text_embedding.tobytes()).digest(), top_k)
+        laws = _law_search_cache.get(key)
+        if laws is not None:
+            return list(laws)
+        
+        if LAW_SEARCH_LOCAL:
+            laws = self._rank_laws_locally(text_embedding, top_k)
+        else:
+            # Rank inside Snowflake - only the top_k rows come back. With unit rows
+            # and a unit query the inner product is the cosine similarity
+            similarity_function = 'VECTOR_INNER_PRODUCT' if LAW_EMBEDDINGS_NORMALIZED else 'VECTOR_COSINE_SIMILARITY'
+            query_vector = text_embedding
+            if LAW_EMBEDDINGS_NORMALIZED:
+                query_vector = _normalize_rows(text_embedding.reshape(1, -1)).ravel()
+            query = f"""
+            SELECT 
+                id,
+                chapter,
+                section,
+                section_title,
+                text,
+                chunk_index,
+                total_chunks,
+                {similarity_function}(
+                    text_embedding,
+                    PARSE_JSON(%s)::ARRAY::VECTOR(FLOAT, 1024)
+                ) AS similarity
+            FROM legal_documents
+            WHERE text_embedding IS NOT NULL
+            ORDER BY similarity DESC
+            LIMIT %s
+            """
+            try:
+                self.cursor.execute(query, (json.dumps(query_vector.tolist()), top_k))
+                laws = [self._law_from_row(row, row[7]) for row in self.cursor.fetchall()]
+            except snowflake.connector.errors.ProgrammingError as e:
+                # Accounts/tables without VECTOR support - rank locally instead
+                print(f"⚠️  Server-side vector search failed, ranking locally: {e}")
+                laws = self._rank_laws_locally(text_embedding, top_k)
+        
+        _law_search_cache.put(key, laws)
+        return list(laws)
+    
+    def search_relevant_laws_batch(self, texts: List[str], top_k: int = 10) -> Dict[int, List[Dict]]:
+        """
+        Search relevant MA laws for many texts with a single Snowflake query
+        
+        Every text is embedded and ranked in the same round trip; the
+        embeddings seed the embedding cache like search_relevant_laws.
+        
+        Args:
+            texts: Query texts (e.g. every chunk of a lease)
+            top_k: Number of results per text
+            
+        Returns:
+            Dict mapping each text's position in texts to its relevant law sections
         """
+        results = {}
+        missing = {}
+        for i, text in enumerate(texts):
+            laws = _law_search_cache.get((_embedding_key(text), top_k))
+            if laws is not None:
+                results[i] = list(laws)
+            else:
+                missing.setdefault(text, []).append(i)
+        if not missing:
+            return results
         
-        self.cursor.execute(embedding_query, (text,))
-        text_embedding = np.array(self.cursor.fetchone()[0])
+        missing_texts = list(missing)
+        if LAW_SEARCH_LOCAL:
+            for text, embedding in zip(missing_texts, self.embed_texts(missing_texts)):
+                laws = self.search_relevant_laws_by_embedding(embedding, top_k)
+                for i in missing[text]:
+                    results[i] = list(laws)
+            return results
         
-        # Get all legal documents with their embeddings
+        query = f"""
+        WITH query_embedding AS (
+            SELECT idx, embedding, SQRT(VECTOR_INNER_PRODUCT(embedding, embedding)) AS norm
+            FROM (
+                SELECT f.index AS idx, SNOWFLAKE.CORTEX.EMBED_TEXT_1024(%s, f.value::STRING) AS embedding
+                FROM TABLE(FLATTEN(input => PARSE_JSON(%s))) f
+            )
+        ),
+        ranked AS (
+            SELECT 
+                q.idx,
+                d.id,
+                d.chapter,
+                d.section,
+                d.section_title,
+                d.text,
+                d.chunk_index,
+                d.total_chunks,
+                {_QUERY_SIMILARITY_SQL} AS similarity,
+                ROW_NUMBER() OVER (PARTITION BY q.idx ORDER BY {_QUERY_SIMILARITY_SQL} DESC) AS rank
+            FROM legal_documents d, query_embedding q
+            WHERE d.text_embedding IS NOT NULL
+            QUALIFY rank <= %s
+        )
+        SELECT 
+            r.idx,
+            r.id,
+            r.chapter,
+            r.section,
+            r.section_title,
+            r.text,
+            r.chunk_index,
+            r.total_chunks,
+            r.similarity,
+            IFF(r.rank = 1, q.embedding, NULL) AS query_embedding
+        FROM ranked r
+        JOIN query_embedding q ON q.idx = r.idx
+        ORDER BY r.idx, r.rank
+        """
+        
+        print(f"🔍 Searching laws for {len(missing_texts)} texts in one query...")
+        try:
+            self.cursor.execute(query, (EMBEDDING_MODEL, json.dumps(missing_texts), top_k))
+            rows = self.cursor.fetchall()
+        except snowflake.connector.errors.ProgrammingError as e:
+            # Accounts/tables without VECTOR support - rank locally instead
+            print(f"⚠️  Server-side vector search failed, ranking locally: {e}")
+            for text, embedding in zip(missing_texts, self.embed_texts(missing_texts)):
+                laws = self._rank_laws_locally(embedding, top_k)
+                for i in missing[text]:
+                    results[i] = list(laws)
+            return results
+        
+        laws_per_text = [[] for _ in missing_texts]
+        embeddings = []
+        for row in rows:
+            laws_per_text[row[0]].append(self._law_from_row(row[1:], row[8]))
+            if row[9] is not None:
+                embeddings.append((_embedding_key(missing_texts[row[0]]), np.asarray(row[9], dtype=np.float32)))
+        _cache_embeddings(embeddings)
+        
+        for text, laws in zip(missing_texts, laws_per_text):
+            _law_search_cache.put((_embedding_key(text), top_k), laws)
+            for i in missing[text]:
+                results[i] = list(laws)
+        return results
+    
+    def _rank_with_query_embedding(self, text: str, top_k: int) -> List[Dict]:
+        """
+        Embed text and rank laws against it in a single Snowflake query
+        
+        The query embedding is returned on the first row only and cached, so
+        the text is never embedded twice and the vector crosses the wire once.
+        """
+        query = f"""
+        WITH query_embedding AS (
+            SELECT embedding, SQRT(VECTOR_INNER_PRODUCT(embedding, embedding)) AS norm
+            FROM (SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_1024(%s, %s) AS embedding)
+        ),
+        ranked AS (
+            SELECT 
+                d.id,
+                d.chapter,
+                d.section,
+                d.section_title,
+                d.text,
+                d.chunk_index,
+                d.total_chunks,
+                {_QUERY_SIMILARITY_SQL} AS similarity
+            FROM legal_documents d, query_embedding q
+            WHERE d.text_embedding IS NOT NULL
+            ORDER BY similarity DESC
+            LIMIT %s
+        )
+        SELECT 
+            r.*,
+            IFF(ROW_NUMBER() OVER (ORDER BY r.similarity DESC) = 1, q.embedding, NULL) AS query_embedding
+        FROM ranked r, query_embedding q
+        ORDER BY r.similarity DESC
+        """
+        
+        try:
+            self.cursor.execute(query, (EMBEDDING_MODEL, text, top_k))
+        except snowflake.connector.errors.ProgrammingError as e:
+            # Accounts/tables without VECTOR support - rank locally instead
+            print(f"⚠️  Server-side vector search failed, ranking locally: {e}")
+            return self._rank_laws_locally(self._embed_text(text), top_k)
+        
+        rows = self.cursor.fetchall()
+        if rows:
+            _cache_embeddings([(_embedding_key(text), np.asarray(rows[0][8], dtype=np.float32))])
+        return [self._law_from_row(row, row[7]) for row in rows]
+    
+    def _embed_text(self, text: str) -> np.ndarray:
+        """Embed text with Cortex, reusing the process-wide embedding cache"""
+        key = _embedding_key(text)
+        embedding = _cached_embedding(key)
+        if embedding is None:
+            self.cursor.execute(
+                "SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_1024(%s, %s) as embedding",
+                (EMBEDDING_MODEL, text)
+            )
+            embedding = np.asarray(self.cursor.fetchone()[0], dtype=np.float32)
+            _cache_embeddings([(key, embedding)])
+        return embedding
+    
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed many texts with a single Cortex query
+        
+        Results seed the embedding cache, so later search_relevant_laws calls
+        for these texts skip EMBED_TEXT_1024. Rows can also be passed straight
+        to search_relevant_laws_by_embedding.
+        
+        Args:
+            texts: Texts to embed (e.g. every chunk of a lease)
+            
+        Returns:
+            (len(texts), 1024) embedding matrix in input order
+        """
+        keys = [_embedding_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if _cached_embedding(key) is None:
+                missing.setdefault(key, text)
+        
+        if missing:
+            print(f"🔢 Embedding {len(missing)} texts in one batch...")
+            query = """
+            SELECT f.index, SNOWFLAKE.CORTEX.EMBED_TEXT_1024(%s, f.value::STRING)
+            FROM TABLE(FLATTEN(input => PARSE_JSON(%s))) f
+            ORDER BY f.index
+            """
+            missing_keys = list(missing)
+            self.cursor.execute(query, (EMBEDDING_MODEL, json.dumps(list(missing.values()))))
+            _cache_embeddings(
+                (missing_keys[index], np.asarray(embedding, dtype=np.float32))
+                for index, embedding in self.cursor.fetchall()
+            )
+        
+        embeddings = []
+        for key, text in zip(keys, texts):
+            embedding = _cached_embedding(key)
+            if embedding is None:  # Evicted by a concurrent request - fetch it alone
+                embedding = self._embed_text(text)
+            embeddings.append(embedding)
+        return np.vstack(embeddings) if embeddings else np.empty((0, 1024), dtype=np.float32)
+    
+    def _rank_laws_locally(self, text_embedding: np.ndarray, top_k: int) -> List[Dict]:
+        """Rank the in-memory law corpus against a query embedding"""
+        rows, law_embeddings = self._get_law_corpus()
+        if not rows:
+            return []
+        
+        law_index = RAGAnalyzer._law_index
+        if law_index is not None:
+            # Approximate nearest neighbours - visits a small part of the corpus
+            k = min(top_k, len(rows))
+            try:
+                law_index.set_ef(max(50, k))
+                labels, distances = law_index.knn_query(np.asarray(text_embedding, dtype=np.float32), k=k)
+                return [self._law_from_row(rows[i], float(1.0 - d)) for i, d in zip(labels[0], distances[0])]
+            except Exception as e:
+                print(f"⚠️  Law index query failed, ranking exactly: {e}")
+        
+        law_bits = RAGAnalyzer._law_bits
+        if law_bits is not None and BINARY_RERANK_FACTOR * top_k < len(rows):
+            # Coarse pass over 1 bit per dimension, exact scores for the survivors only
+            candidates = _binary_candidates(law_bits, text_embedding, BINARY_RERANK_FACTOR * top_k)
+            similarities = _law_similarities(law_embeddings[candidates], text_embedding)
+            return [
+                self._law_from_row(rows[candidates[i]], float(similarities[i]))
+                for i in _top_k_indices(similarities, top_k)
+            ]
+        
+        similarities = _law_similarities(law_embeddings, text_embedding)
+        
+        return [self._law_from_row(rows[i], float(similarities[i])) for i in _top_k_indices(similarities, top_k)]
+    
+    def binary_prefilter_recall(self, top_k: int = 10, sample_size: int = 200) -> float:
+        """
+        Measure recall@top_k of the LAW_SEARCH_BINARY pre-filter against exact ranking
+        
+        Law embeddings from the corpus itself serve as sample queries.
+        """
+        rows, law_embeddings = self._get_law_corpus()
+        if not rows:
+            return 1.0
+        
+        law_bits = _sign_bits(law_embeddings)
+        sample = np.random.default_rng(0).choice(len(rows), size=min(sample_size, len(rows)), replace=False)
+        found = 0
+        for i in sample:
+            query = law_embeddings[i].astype(np.float32)
+            exact = _top_k_indices(_law_similarities(law_embeddings, query), top_k)
+            candidates = _binary_candidates(law_bits, query, BINARY_RERANK_FACTOR * top_k)
+            approx = candidates[_top_k_indices(_law_similarities(law_embeddings[candidates], query), top_k)]
+            found += len(np.intersect1d(exact, approx))
+        recall = found / (len(sample) * min(top_k, len(rows)))
+        print(f"✓ Binary pre-filter recall@{top_k}: {recall:.3f} over {len(sample)} queries")
+        return recall
+    
+    def _get_law_corpus(self):
+        """Get the (rows, matrix) law corpus, loading it once per process"""
+        cls = RAGAnalyzer
+        with cls._corpus_lock:
+            if cls._law_rows is None:
+                cls._law_rows, cls._law_embeddings = self._fetch_law_embeddings()
+                cls._loaded_at = datetime.now()
+                print(f"✓ Loaded {len(cls._law_rows)} law embeddings into memory")
+                if LAW_SEARCH_HNSW and cls._law_rows:
+                    if not HNSWLIB_AVAILABLE:
+                        print("⚠️  LAW_SEARCH_HNSW is set but hnswlib is not installed")
+                    else:
+                        try:
+                            cls._law_index = _load_or_build_law_index(cls._law_embeddings)
+                        except Exception as e:
+                            print(f"⚠️  Could not build law index: {e}")
+                if cls._law_index is None and LAW_SEARCH_BINARY and cls._law_rows:
+                    cls._law_bits = _sign_bits(cls._law_embeddings)
+                ranker = ('HNSW (approximate)' if cls._law_index is not None
+                          else 'binary pre-filter + exact re-rank' if cls._law_bits is not None
+                          else 'exact')
+                print(f"✓ Local law ranking: {ranker}")
+            return cls._law_rows, cls._law_embeddings
+    
+    def refresh_corpus(self):
+        """Reload the in-memory law corpus (e.g. after legal_documents changes)"""
+        with RAGAnalyzer._corpus_lock:
+            RAGAnalyzer._law_rows = None
+            RAGAnalyzer._law_index = None
+            RAGAnalyzer._law_bits = None
+        _law_search_cache.clear()
+        return self._get_law_corpus()
+    
+    def _fetch_law_embeddings(self):
+        """
+        Fetch all law rows with an embedding matrix for local ranking
+        
+        Prefers the int8 column written by build_quantized_embeddings (1 byte per
+        dimension on the wire) and falls back to the float embeddings otherwise.
+        
+        Returns:
+            Tuple of (rows, matrix) - matrix is raw int8 or unit-row float32
+        """
         query = """
         SELECT 
             id,
@@ -166,37 +1151,100 @@ Return ONLY valid JSON, no additional text."""
             text,
             chunk_index,
             total_chunks,
-            text_embedding
+            {embedding_column}
         FROM legal_documents
         WHERE text_embedding IS NOT NULL
         """
         
-        self.cursor.execute(query)
+        try:
+            self.cursor.execute(query.format(embedding_column=QUANTIZED_EMBEDDING_COLUMN))
+            rows = self.cursor.fetchall()
+            if rows and all(row[7] is not None for row in rows):
+                packed = np.frombuffer(b''.join(bytes(row[7]) for row in rows), dtype=np.int8)
+                return _drop_zero_rows([row[:7] for row in rows], packed.reshape(len(rows), -1))
+        except snowflake.connector.errors.ProgrammingError:
+            pass  # Column not built yet
         
-        # Compute similarities locally
-        results = []
-        for row in self.cursor:
-            doc_embedding = np.array(row[7])
-            
-            # Cosine similarity
-            similarity = np.dot(text_embedding, doc_embedding) / (
-                np.linalg.norm(text_embedding) * np.linalg.norm(doc_embedding)
-            )
-            
-            results.append({
-                'id': row[0],
-                'chapter': row[1],
-                'section': row[2],
-                'section_title': row[3],
-                'text': row[4],
-                'chunk_index': row[5],
-                'total_chunks': row[6],
-                'similarity': similarity
-            })
+        self.cursor.execute(query.format(embedding_column='text_embedding'))
+        try:
+            # Columnar Arrow fetch - metadata and embeddings are decoded in bulk
+            # instead of one Python tuple per row
+            table = self.cursor.fetch_arrow_all()
+        except (ImportError, snowflake.connector.errors.Error):
+            # pyarrow extra not installed
+            rows = self.cursor.fetchall()
+            if not rows:
+                return rows, None
+            matrix = _stack_float32(row[7] for row in rows)
+            rows = [row[:7] for row in rows]
+        else:
+            if table is None or table.num_rows == 0:
+                return [], None
+            rows = list(zip(*(column.to_pylist() for column in table.columns[:7])))
+            matrix = _arrow_vectors(table.column(7))
         
-        # Sort by similarity (highest first) and return top_k
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        return results[:top_k]
+        # One contiguous float32 matrix (half the memory traffic of float64),
+        # normalized once in place so scoring needs no norms or division
+        rows, matrix = _drop_zero_rows(rows, matrix)
+        return rows, _normalize_rows(matrix, in_place=True)
+    
+    def build_quantized_embeddings(self):
+        """
+        One-time migration: store an int8 copy of every law embedding
+        
+        Vectors are normalized and scaled to [-127, 127], cutting the local
+        ranking fetch to a quarter of float32 (an eighth of float64).
+        """
+        self.cursor.execute(
+            f"ALTER TABLE legal_documents ADD COLUMN IF NOT EXISTS {QUANTIZED_EMBEDDING_COLUMN} BINARY"
+        )
+        self.cursor.execute("SELECT id, text_embedding FROM legal_documents WHERE text_embedding IS NOT NULL")
+        rows = self.cursor.fetchall()
+        if not rows:
+            return 0
+        
+        quantized = _quantize_unit(_normalize_rows(np.asarray([row[1] for row in rows], dtype=np.float32)))
+        self.cursor.executemany(
+            f"UPDATE legal_documents SET {QUANTIZED_EMBEDDING_COLUMN} = %s WHERE id = %s",
+            [(vector.tobytes(), row[0]) for vector, row in zip(quantized, rows)]
+        )
+        self.conn.commit()
+        print(f"✓ Quantized {len(rows)} law embeddings to int8")
+        return len(rows)
+    
+    def normalize_law_embeddings(self):
+        """
+        One-time migration: rewrite every law embedding at unit length
+        
+        Run before setting LAW_EMBEDDINGS_NORMALIZED. Anything that inserts
+        into legal_documents afterwards must store unit-length vectors too.
+        """
+        self.cursor.execute("SELECT id, text_embedding FROM legal_documents WHERE text_embedding IS NOT NULL")
+        rows = self.cursor.fetchall()
+        if not rows:
+            return 0
+        
+        unit = _normalize_rows(_stack_float32(row[1] for row in rows), in_place=True)
+        self.cursor.executemany(
+            "UPDATE legal_documents SET text_embedding = PARSE_JSON(%s)::ARRAY::VECTOR(FLOAT, 1024) WHERE id = %s",
+            [(json.dumps(vector.tolist()), row[0]) for vector, row in zip(unit, rows)]
+        )
+        self.conn.commit()
+        print(f"✓ Normalized {len(rows)} law embeddings")
+        return len(rows)
+    
+    def _law_from_row(self, row, similarity: float) -> Dict:
+        """Build a law section dict from a legal_documents row"""
+        return {
+            'id': row[0],
+            'chapter': row[1],
+            'section': row[2],
+            'section_title': row[3],
+            'text': row[4],
+            'chunk_index': row[5],
+            'total_chunks': row[6],
+            'similarity': similarity
+        }
     
     def analyze_chunk(self, lease_chunk: Dict, relevant_laws: List[Dict]) -> Dict:
         """
@@ -209,103 +1257,17 @@ Return ONLY valid JSON, no additional text."""
         Returns:
             Analysis results
         """
-        # Prepare legal context
-        law_context = []
-        for law in relevant_laws:
-            law_context.append(
-                f"[Chapter {law['chapter']}, {law['section']}]\n{law['text']}"
-            )
-        
-        context = "\n\n---\n\n".join(law_context)
-        
-        # Create analysis prompt
-        prompt = f"""You are a legal expert specializing in Massachusetts tenant rights and housing law.
-
-Analyze the following lease agreement clause against Massachusetts General Laws (Chapter 186 - Estates for Years and at Will, and Chapter 93A - Consumer Protection).
-
-LEASE AGREEMENT CLAUSE (Chunk {lease_chunk['chunk_index']}/{lease_chunk['total_chunks']}):
-{lease_chunk['text']}
-
-RELEVANT MASSACHUSETTS LAWS:
-{context}
-
-Provide a detailed analysis in JSON format with the following structure:
-{{
-    "illegal_clauses": [
-        {{
-            "clause": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
-            "violation": "which law/statute it violates",
-            "explanation": "why this is illegal",
-            "severity": "high/critical",
-            "potential_recovery": "estimated dollar amount tenant could recover (e.g., $5000)",
-            "recovery_calculation": "detailed explanation of how this amount is calculated under MA law, citing specific statutory remedies"
-        }}
-    ],
-    "risky_terms": [
-        {{
-            "term": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
-            "risk": "potential legal issue",
-            "explanation": "why this could be problematic",
-            "severity": "medium/high"
-        }}
-    ],
-    "favorable_clauses": [
-        {{
-            "clause": "EXACT VERBATIM text copied word-for-word from the lease above, including all punctuation",
-            "benefit": "how this protects the tenant",
-            "relevant_law": "supporting statute if any"
-        }}
-    ],
-    "concerns": [
-        {{
-            "issue": "description of concern",
-            "recommendation": "what should be done"
-        }}
-    ]
-}}
-
-CRITICAL INSTRUCTIONS FOR TEXT EXTRACTION:
-- For the "clause", "term", and "clause" fields, you MUST copy the EXACT text as it appears in the lease above
-- Do NOT paraphrase, summarize, or reword the text in any way
-- Copy the text VERBATIM, character by character, including all punctuation, capitalization, and spacing
-- Include complete sentences or paragraphs that contain the problematic language
-- The text you provide will be used to locate the clause in the PDF, so precision is essential
-
-Be thorough and cite specific statutes. If a clause is found in the lease that violates MA law, mark it as illegal.
-
-Common violations and their penalties under Massachusetts law:
-- Security deposit violations (Chapter 186, §15B): Up to 3x the deposit amount plus attorney's fees and costs
-- Chapter 93A consumer protection violations: Double or triple damages (actual damages × 2 or × 3)
-- Illegal exculpatory clauses (Chapter 186, §15): Actual damages plus statutory penalties
-- Attorney fee violations (Chapter 186, §20): Attorney's fees if tenant prevails
-- Waiver of tenant rights: Actual damages and potential punitive damages
-- Improper security deposit handling: $1,000-$5,000 typical range
-- Prohibited lease terms (Chapter 186, §15B): Actual damages plus statutory remedies
-
-For each illegal clause, estimate the potential recovery based on:
-1. The specific statute violated and its remedies
-2. Typical damages awarded in MA courts for similar violations
-3. Whether multiple damages (2x, 3x) apply under Chapter 93A
-4. Attorney's fees and costs if applicable
-
-Return ONLY valid JSON, no additional text."""
-
-        # Call Gemini for analysis
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        response = model.generate_content(prompt)
+        prompt = _ANALYSIS_PROMPT_TEMPLATE.format(
+            chunk_index=lease_chunk['chunk_index'],
+            total_chunks=lease_chunk['total_chunks'],
+            clause=lease_chunk['text'],
+            context=self._law_context(relevant_laws)
+        )
+        response = _call_gemini(self.gemini, prompt, f"chunk {lease_chunk['chunk_index']}", ANALYSIS_GENERATION_CONFIG)
         
         # Parse JSON response
         try:
-            response_text = response.text.strip()
-            
-            # Remove markdown code blocks if present
-            if '```json' in response_text:
-                response_text = response_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in response_text:
-                response_text = response_text.split('```')[1].split('```')[0].strip()
-            
-            analysis = json.loads(response_text)
-            return analysis
+            return _loads(response.text)
         except json.JSONDecodeError as e:
             print(f"⚠️  Warning: Could not parse JSON from Gemini response: {e}")
             return {
@@ -315,6 +1277,144 @@ Return ONLY valid JSON, no additional text."""
                 "concerns": [{"issue": "Analysis parsing error", "recommendation": "Manual review recommended"}]
             }
     
+    def analyze_chunk_batch(self, lease_chunks: List[Dict], laws_per_chunk: List[List[Dict]]) -> List[Dict]:
+        """
+        Analyze several lease chunks with a single Gemini call
+        
+        The union of the chunks' relevant laws is sent once as shared context.
+        Chunks missing from the response (e.g. truncated output) are analyzed
+        on their own instead.
+        
+        Args:
+            lease_chunks: Chunks to analyze together
+            laws_per_chunk: Relevant law sections for each chunk (same order)
+            
+        Returns:
+            Analysis results in the same order as lease_chunks
+        """
+        if len(lease_chunks) == 1:
+            return [self.analyze_chunk(lease_chunks[0], laws_per_chunk[0])]
+        
+        # Each law is sent once; clauses refer to their laws by label (L1, L2, ...)
+        shared_laws = list({law['id']: law for laws in laws_per_chunk for law in laws}.values())
+        law_labels = {law['id']: f"L{n}" for n, law in enumerate(shared_laws, 1)}
+        clauses = "\n\n---\n\n".join(
+            f"LEASE AGREEMENT CLAUSE (Chunk {chunk['chunk_index']}/{chunk['total_chunks']}) - "
+            f"relevant laws: {', '.join(law_labels[law['id']] for law in laws) or 'none'}:\n{chunk['text']}"
+            for chunk, laws in zip(lease_chunks, laws_per_chunk)
+        )
+        prompt = _BATCH_ANALYSIS_PROMPT_TEMPLATE.format(
+            clauses=clauses, context=self._law_context(shared_laws, labeled=True)
+        )
+        label = f"chunks {lease_chunks[0]['chunk_index']}-{lease_chunks[-1]['chunk_index']}"
+        response = _call_gemini(self.gemini, prompt, label, BATCH_ANALYSIS_GENERATION_CONFIG)
+        
+        try:
+            results = _loads(response.text).get('results') or []
+        except (json.JSONDecodeError, AttributeError) as e:
+            print(f"⚠️  Warning: Could not parse batched analysis for {label}, analyzing separately: {e}")
+            results = []
+        by_index = {result.pop('chunk_index', None): result for result in results if isinstance(result, dict)}
+        
+        return [
+            by_index[chunk['chunk_index']] if chunk['chunk_index'] in by_index else self.analyze_chunk(chunk, laws)
+            for chunk, laws in zip(lease_chunks, laws_per_chunk)
+        ]
+    
+    def _law_context(self, relevant_laws: List[Dict], labeled: bool = False) -> str:
+        """
+        Join law sections into prompt context - chunks usually share their top laws, so the text is reused
+        
+        With labeled=True each section is prefixed with its position label
+        (L1, L2, ...) for batched prompts to refer to.
+        """
+        context_key = (labeled,) + tuple(law['id'] for law in relevant_laws)
+        context = _law_context_cache.get(context_key)
+        if context is None:
+            context = "\n\n---\n\n".join(
+                f"{f'[L{n}] ' if labeled else ''}[Chapter {law['chapter']}, {law['section']}]\n{law['text']}"
+                for n, law in enumerate(relevant_laws, 1)
+            )
+            _law_context_cache.put(context_key, context)
+        return context
+    
+    async def analyze_chunk_async(self, lease_chunk: Dict, relevant_laws: List[Dict]) -> Dict:
+        """analyze_chunk without blocking the event loop (the Gemini call runs in a worker thread)"""
+        return await asyncio.to_thread(self.analyze_chunk, lease_chunk, relevant_laws)
+    
+    async def analyze_all_chunks(self, lease_chunks: List[Dict], laws_per_chunk: List[List[Dict]],
+                                 max_concurrency: int = ANALYSIS_CONCURRENCY,
+                                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                                 batch_size: int = 1) -> List[Dict]:
+        """
+        Analyze many lease chunks concurrently, at most max_concurrency calls at a time
+        
+        Args:
+            lease_chunks: Chunks to analyze
+            laws_per_chunk: Relevant law sections for each chunk (same order)
+            max_concurrency: Maximum Gemini calls in flight
+            progress_callback: Optional callable(completed, total) run as chunks finish
+            batch_size: Chunks sent per Gemini prompt (see analyze_chunk_batch)
+            
+        Returns:
+            Analysis results in the same order as lease_chunks - chunks whose
+            analysis failed get a concern asking for manual review
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        total = len(lease_chunks)
+        completed = 0
+        batch_size = max(1, batch_size)
+        batches = [
+            (lease_chunks[i:i + batch_size], laws_per_chunk[i:i + batch_size])
+            for i in range(0, total, batch_size)
+        ]
+        
+        async def run(chunks, laws):
+            nonlocal completed
+            async with semaphore:
+                try:
+                    if len(chunks) == 1:
+                        return [await self.analyze_chunk_async(chunks[0], laws[0])]
+                    return await asyncio.to_thread(self.analyze_chunk_batch, chunks, laws)
+                finally:
+                    completed += len(chunks)
+                    if progress_callback:
+                        progress_callback(completed, total)
+        
+        results = await asyncio.gather(*(run(chunks, laws) for chunks, laws in batches), return_exceptions=True)
+        
+        analyses = []
+        for (chunks, _), result in zip(batches, results):
+            if isinstance(result, Exception):
+                print(f"⚠️  Analysis of chunks {chunks[0]['chunk_index']}-{chunks[-1]['chunk_index']} failed: {result}")
+                result = [{
+                    "illegal_clauses": [],
+                    "risky_terms": [],
+                    "favorable_clauses": [],
+                    "concerns": [{"issue": "Analysis failed for part of the lease", "recommendation": "Manual review recommended"}]
+                } for _ in chunks]
+            analyses.extend(result)
+        return analyses
+    
+    def analyze_chunks(self, lease_chunks: List[Dict], laws_per_chunk: List[List[Dict]],
+                       progress_callback: Optional[Callable[[int, int], None]] = None,
+                       batch_size: int = ANALYSIS_BATCH_SIZE) -> List[Dict]:
+        """
+        Analyze many lease chunks with batched, overlapping Gemini calls (sync wrapper)
+        
+        Args:
+            lease_chunks: Chunks to analyze
+            laws_per_chunk: Relevant law sections for each chunk (same order)
+            progress_callback: Optional callable(completed, total) run as chunks finish
+            batch_size: Chunks sent per Gemini prompt
+            
+        Returns:
+            Analysis results in the same order as lease_chunks
+        """
+        return asyncio.run(self.analyze_all_chunks(
+            lease_chunks, laws_per_chunk, progress_callback=progress_callback, batch_size=batch_size
+        ))
+    
     def consolidate_analysis(self, chunk_analyses: List[Dict], full_lease_text: str, 
                            metadata: Dict = None, pii_summary: Dict = None, file_id: str = None, 
                            pdf_path: str = None) -> Dict:
@@ -340,11 +1440,12 @@ Return ONLY valid JSON, no additional text."""
         all_favorable = []
         all_concerns = []
         
+        # `or ()` skips the per-chunk default list and tolerates null fields
         for analysis in chunk_analyses:
-            all_illegal.extend(analysis.get('illegal_clauses', []))
-            all_risky.extend(analysis.get('risky_terms', []))
-            all_favorable.extend(analysis.get('favorable_clauses', []))
-            all_concerns.extend(analysis.get('concerns', []))
+            all_illegal.extend(analysis.get('illegal_clauses') or ())
+            all_risky.extend(analysis.get('risky_terms') or ())
+            all_favorable.extend(analysis.get('favorable_clauses') or ())
+            all_concerns.extend(analysis.get('concerns') or ())
         
         # Calculate metrics
         illegal_count = len(all_illegal)
@@ -354,68 +1455,52 @@ Return ONLY valid JSON, no additional text."""
         power_imbalance = min(100, (illegal_count * 20) + (risky_count * 10) - (favorable_count * 5))
         power_imbalance = max(0, power_imbalance)
         
-        # Calculate potential recovery
-        potential_recovery = 0
-        recovery_breakdown = []
+        summary = self._generate_summary(illegal_count, risky_count, favorable_count, power_imbalance)
         
+        # Calculate potential recovery as (violation, amount, calculation) per illegal clause
+        recoveries = []
         for illegal in all_illegal:
-            recovery_str = illegal.get('potential_recovery', '')
+            violation = illegal.get('violation', 'Unknown')
             recovery_calc = illegal.get('recovery_calculation', '')
             
-            # Parse dollar amount
-            match = re.search(r'\$?(\d{1,3}(?:,?\d{3})*)', recovery_str)
+            # Parse dollar amount, falling back to an estimate by violation type
+            match = _MONEY_RE.search(illegal.get('potential_recovery', ''))
             if match:
                 amount = int(match.group(1).replace(',', ''))
-                potential_recovery += amount
-                recovery_breakdown.append({
-                    'violation': illegal.get('violation', 'Unknown'),
-                    'amount': amount,
-                    'calculation': recovery_calc
-                })
             else:
-                # Fallback estimate
-                if 'security deposit' in illegal.get('violation', '').lower():
-                    amount = 5000
-                elif '93a' in illegal.get('violation', '').lower():
-                    amount = 2500
-                else:
-                    amount = 1000
-                potential_recovery += amount
-                recovery_breakdown.append({
-                    'violation': illegal.get('violation', 'Unknown'),
-                    'amount': amount,
-                    'calculation': recovery_calc or 'Estimated based on violation type'
-                })
-        
-        severity_level = self._get_severity_level(power_imbalance, illegal_count)
-        
-        # Determine risk level
-        if illegal_count >= 3:
-            risk_level = "Critical"
-        elif illegal_count >= 1:
-            risk_level = "High"
-        elif risky_count >= 5:
-            risk_level = "Medium"
-        else:
-            risk_level = "Low"
+                amount = _fallback_recovery(violation or '')
+                recovery_calc = recovery_calc or 'Estimated based on violation type'
+            recoveries.append((violation, amount, recovery_calc))
+        potential_recovery = sum(amount for _, amount, _ in recoveries)
         
         # If enhanced output requested (metadata provided)
         if metadata and file_id and pdf_path:
             print("   Creating highlights with PDF coordinates...")
             
+            # Determine risk level
+            if illegal_count >= 3:
+                risk_level = "Critical"
+            elif illegal_count >= 1:
+                risk_level = "High"
+            elif risky_count >= 5:
+                risk_level = "Medium"
+            else:
+                risk_level = "Low"
+            
             # Create highlights with PDF coordinates
             highlights = self._create_highlights_with_coordinates(
                 all_illegal, all_risky, all_favorable, pdf_path
             )
             
             # Get top issues
-            top_issues = []
-            for i, illegal in enumerate(all_illegal[:3]):
-                top_issues.append({
+            top_issues = [
+                {
                     "title": illegal.get('violation', 'Unknown Violation'),
                     "severity": illegal.get('severity', 'high'),
-                    "amount": f"${recovery_breakdown[i]['amount']}" if i < len(recovery_breakdown) else "$0"
-                })
+                    "amount": f"${amount}"
+                }
+                for illegal, (_, amount, _) in zip(all_illegal[:3], recoveries)
+            ]
             
             # Build complete JSON structure
             return {
@@ -448,8 +1533,7 @@ Return ONLY valid JSON, no additional text."""
                 },
                 "analysisSummary": {
                     "status": "complete",
-                    "summaryText": f"Analysis Complete — {illegal_count} key issues found. " + 
-                                  self._generate_summary(illegal_count, risky_count, favorable_count, power_imbalance),
+                    "summaryText": f"Analysis Complete — {illegal_count} key issues found. {summary}",
                     "overallRisk": risk_level,
                     "issuesFound": illegal_count,
                     "potential_recovery": potential_recovery,
@@ -472,9 +1556,12 @@ Return ONLY valid JSON, no additional text."""
                 "concerns": all_concerns,
                 "power_imbalance_score": power_imbalance,
                 "potential_recovery_amount": potential_recovery,
-                "recovery_breakdown": recovery_breakdown,
-                "severity_level": severity_level,
-                "summary": self._generate_summary(illegal_count, risky_count, favorable_count, power_imbalance)
+                "recovery_breakdown": [
+                    {'violation': violation, 'amount': amount, 'calculation': recovery_calc}
+                    for violation, amount, recovery_calc in recoveries
+                ],
+                "severity_level": self._get_severity_level(power_imbalance, illegal_count),
+                "summary": summary
             }
     
     def _create_highlights_with_coordinates(self, illegal_clauses: List[Dict], 
@@ -496,117 +1583,87 @@ Return ONLY valid JSON, no additional text."""
         highlights = []
         highlight_id = 1
         
-        # Initialize PDF coordinate extractor
-        try:
-            from pdf_coordinate_extractor import PDFCoordinateExtractor
-            coord_extractor = PDFCoordinateExtractor(pdf_path)
-        except Exception as e:
-            print(f"⚠️  Could not initialize coordinate extractor: {e}")
-            coord_extractor = None
-        
         # Add illegal clauses (red highlights)
         for illegal in illegal_clauses:
-            text = illegal.get('clause', '')
-            
-            # Get coordinates
-            if coord_extractor:
-                position = coord_extractor.find_text_coordinates(text)
-            else:
-                position = self._get_default_position(1)
-            
             highlights.append({
                 "id": f"hl-{highlight_id:03d}",
-                "pageNumber": position['boundingRect']['pageNumber'],
+                "pageNumber": None,
                 "color": "red",
                 "priority": 1,
                 "category": illegal.get('violation', 'Legal Violation'),
-                "text": text,
+                "text": illegal.get('clause', ''),
                 "statute": illegal.get('violation', ''),
                 "explanation": illegal.get('explanation', ''),
                 "damages_estimate": self._parse_amount(illegal.get('potential_recovery', '0')),
-                "position": position
+                "position": None
             })
             highlight_id += 1
         
         # Add risky terms (orange/yellow highlights)
         for risky in risky_terms:
-            text = risky.get('term', '')
             severity = risky.get('severity', 'medium')
-            
-            if coord_extractor:
-                position = coord_extractor.find_text_coordinates(text)
-            else:
-                position = self._get_default_position(1)
-            
             highlights.append({
                 "id": f"hl-{highlight_id:03d}",
-                "pageNumber": position['boundingRect']['pageNumber'],
+                "pageNumber": None,
                 "color": "orange" if severity == "high" else "yellow",
                 "priority": 2 if severity == "high" else 3,
                 "category": risky.get('risk', 'Risky Term'),
-                "text": text,
+                "text": risky.get('term', ''),
                 "statute": "M.G.L. c. 186",
                 "explanation": risky.get('explanation', ''),
                 "damages_estimate": 0,
-                "position": position
+                "position": None
             })
             highlight_id += 1
         
         # Add favorable clauses (green highlights)
         for favorable in favorable_clauses:
-            text = favorable.get('clause', '')
-            
-            if coord_extractor:
-                position = coord_extractor.find_text_coordinates(text)
-            else:
-                position = self._get_default_position(1)
-            
             highlights.append({
                 "id": f"hl-{highlight_id:03d}",
-                "pageNumber": position['boundingRect']['pageNumber'],
+                "pageNumber": None,
                 "color": "green",
                 "priority": 3,
                 "category": favorable.get('benefit', 'Favorable Clause'),
-                "text": text,
+                "text": favorable.get('clause', ''),
                 "statute": favorable.get('relevant_law', ''),
                 "explanation": favorable.get('benefit', ''),
                 "damages_estimate": 0,
-                "position": position
+                "position": None
             })
             highlight_id += 1
         
-        if coord_extractor:
-            coord_extractor.close()
+        # Locate every highlight in one pass over the PDF
+        positions = {}
+        try:
+            from pdf_coordinate_extractor import PDFCoordinateExtractor
+            with PDFCoordinateExtractor(pdf_path) as coord_extractor:
+                coord_extractor.warmup()
+                positions = coord_extractor.find_all_coordinates(highlights)
+        except Exception as e:
+            print(f"⚠️  Could not extract highlight coordinates: {e}")
+        
+        for highlight in highlights:
+            position = positions.get(highlight['id']) or self._get_default_position(1)
+            highlight['pageNumber'] = position['boundingRect']['pageNumber']
+            highlight['position'] = position
         
         return highlights
     
     def _parse_amount(self, amount_str: str) -> int:
         """Parse dollar amount from string"""
-        match = re.search(r'\$?(\d{1,3}(?:,?\d{3})*)', str(amount_str))
+        match = _MONEY_RE.search(str(amount_str))
         if match:
             return int(match.group(1).replace(',', ''))
         return 0
     
     def _get_default_position(self, page_num: int) -> Dict:
-        """Get default position when coordinates cannot be extracted"""
-        return {
-            "boundingRect": {
-                "x1": 72,
-                "y1": 200,
-                "x2": 540,
-                "y2": 250,
-                "pageNumber": page_num
-            },
-            "rects": [
-                {
-                    "x1": 72,
-                    "y1": 200,
-                    "x2": 540,
-                    "y2": 250,
-                    "pageNumber": page_num
-                }
-            ]
-        }
+        """Get default position when coordinates cannot be extracted (shared per page - treat as read-only)"""
+        position = _default_positions.get(page_num)
+        if position is None:
+            rect = {**_DEFAULT_RECT, "pageNumber": page_num}
+            position = {"boundingRect": rect, "rects": [rect]}
+            _default_positions[page_num] = position
+        return position
     
     def _get_severity_level(self, power_score: int, illegal_count: int) -> str:
         """Determine overall severity level"""
@@ -648,7 +1705,17 @@ Return ONLY valid JSON, no additional text."""
         Returns:
             AI-generated answer
         """
+        global _working_chat_model_name
         try:
+            # Document-specific answers go stale, so only general questions are cached
+            question_embedding = None
+            if not context:
+                question_embedding = self._embed_text(question)
+                cached_answer = self._lookup_chat_cache(question_embedding)
+                if cached_answer:
+                    print("✅ Reusing cached answer for a similar question")
+                    return cached_answer
+            
             # Prepare context
             law_context = []
             for law in relevant_laws:
@@ -702,55 +1769,35 @@ Please provide a helpful, clear answer to the user's question. Be conversational
             
             print(f"🤖 Generating chat response with Gemini for question: {question[:100]}...")
             
-            # Try different Gemini models in order of preference
-            models_to_try = [
-                'gemini-1.5-flash',  # Fast and reliable
-                'gemini-1.5-pro',    # More capable
-                'gemini-pro',        # Stable fallback
-                'gemini-2.0-flash-exp',  # Experimental
-            ]
+            # Try the model that last worked, then the rest in order of preference
+            models_to_try = list(CHAT_MODEL_NAMES)
+            if _working_chat_model_name:
+                models_to_try.remove(_working_chat_model_name)
+                models_to_try.insert(0, _working_chat_model_name)
             
-            model = None
-            response = None
             last_error = None
-            
             for model_name in models_to_try:
                 try:
                     print(f"   Trying model: {model_name}")
-                    # Create generation config as dict
-                    generation_config = {
-                        'temperature': 0.7,  # Balance between creative and factual
-                        'top_p': 0.95,
-                        'top_k': 40,
-                        'max_output_tokens': 1024,
-                    }
-                    model = genai.GenerativeModel(
-                        model_name,
-                        generation_config=generation_config
-                    )
-                    response = model.generate_content(prompt)
+                    model = _get_chat_model(model_name)
+                    response = _call_gemini(model, prompt, f"chat ({model_name})")
                     print(f"   ✅ Successfully used model: {model_name}")
+                    _working_chat_model_name = model_name
                     break
                 except Exception as e:
                     print(f"   ⚠️  Model {model_name} failed: {e}")
                     last_error = e
-                    continue
-            
-            if not response:
-                raise Exception(f"All Gemini models failed. Last error: {last_error}")
+            else:
+                raise Exception(f"All Gemini models failed. Last error: {last_error}") from last_error
             
-            # Extract text from response
-            answer = None
-            if hasattr(response, 'text') and response.text:
+            # Extract text from response - .text raises ValueError when the response has no text part
+            try:
                 answer = response.text.strip()
-            elif hasattr(response, 'candidates') and response.candidates:
-                if len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                        if len(candidate.content.parts) > 0:
-                            answer = candidate.content.parts[0].text.strip()
-                    elif hasattr(candidate, 'text'):
-                        answer = candidate.text.strip()
+            except (AttributeError, ValueError):
+                try:
+                    answer = response.candidates[0].content.parts[0].text.strip()
+                except (AttributeError, IndexError):
+                    answer = None
             
             if not answer:
                 # Last resort: try to convert to string
@@ -759,6 +1806,8 @@ Please provide a helpful, clear answer to the user's question. Be conversational
                     raise Exception("Could not extract text from Gemini response")
             
             print(f"✅ Generated response ({len(answer)} chars): {answer[:100]}...")
+            if question_embedding is not None:
+                self._store_chat_cache(question_embedding, answer)
             return answer
             
         except Exception as e:
@@ -766,6 +1815,69 @@ Please provide a helpful, clear answer to the user's question. Be conversational
             # Return a helpful fallback message
             return f"I apologize, but I encountered an error while generating a response. Please try rephrasing your question. Error: {str(e)}"
     
+    def _ensure_chat_cache(self):
+        """Create the semantic chat cache table once per process"""
+        global _chat_cache_ready
+        if not _chat_cache_ready:
+            self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_semantic_cache (
+                query_embedding VECTOR(FLOAT, 1024),
+                response TEXT,
+                ts TIMESTAMP
+            )
+            """)
+            _chat_cache_ready = True
+    
+    def _lookup_chat_cache(self, question_embedding: np.ndarray) -> Optional[str]:
+        """Get the cached answer of the most similar earlier question, if close enough"""
+        query = """
+        SELECT 
+            response,
+            VECTOR_COSINE_SIMILARITY(
+                query_embedding,
+                PARSE_JSON(%s)::ARRAY::VECTOR(FLOAT, 1024)
+            ) AS similarity
+        FROM chat_semantic_cache
+        WHERE ts > DATEADD(hour, -%s, CURRENT_TIMESTAMP())
+        ORDER BY similarity DESC
+        LIMIT 1
+        """
+        try:
+            self._ensure_chat_cache()
+            self.cursor.execute(query, (json.dumps(question_embedding.tolist()), CHAT_CACHE_TTL_HOURS))
+            row = self.cursor.fetchone()
+        except snowflake.connector.errors.Error as e:
+            print(f"⚠️  Chat cache lookup failed: {e}")
+            return None
+        if row and row[1] is not None and row[1] >= CHAT_CACHE_THRESHOLD:
+            return row[0]
+        return None
+    
+    def _store_chat_cache(self, question_embedding: np.ndarray, answer: str):
+        """Remember an answer for semantically similar future questions"""
+        query = """
+        INSERT INTO chat_semantic_cache (query_embedding, response, ts)
+        SELECT PARSE_JSON(%s)::ARRAY::VECTOR(FLOAT, 1024), %s, CURRENT_TIMESTAMP()
+        """
+        try:
+            self._ensure_chat_cache()
+            self.cursor.execute(query, (json.dumps(question_embedding.tolist()), answer))
+            self._prune_chat_cache()
+            self.conn.commit()
+        except snowflake.connector.errors.Error as e:
+            print(f"⚠️  Could not cache chat answer: {e}")
+    
+    def _prune_chat_cache(self):
+        """Delete expired cached answers, at most once per CHAT_CACHE_PRUNE_INTERVAL"""
+        global _chat_cache_pruned_at
+        if _chat_cache_pruned_at is not None and time.monotonic() - _chat_cache_pruned_at < CHAT_CACHE_PRUNE_INTERVAL:
+            return
+        self.cursor.execute(
+            "DELETE FROM chat_semantic_cache WHERE ts <= DATEADD(hour, -%s, CURRENT_TIMESTAMP())",
+            (CHAT_CACHE_TTL_HOURS,)
+        )
+        _chat_cache_pruned_at = time.monotonic()
+    
     def close(self):
         """Close Snowflake connection"""
         self.cursor.close()
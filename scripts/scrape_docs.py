@@ -1,10 +1,29 @@
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+import asyncio
+import lxml.html
+from lxml import etree
 import json
+import os
 import time
+from tqdm import tqdm
 
 BASE_URL = "https://malegislature.gov/Laws/GeneralLaws"
 
+# Section pages fetched at once - keeps the load on malegislature.gov polite
+SCRAPE_CONCURRENCY = 8
+
+# Average request rate against malegislature.gov (requests per second)
+SCRAPE_RATE = 2
+
+# Identify the scraper to the site; sent on every request of the shared session
+SCRAPE_HEADERS = {'User-Agent': 'clause-backend-scraper/1.0'}
+
+# Section links on a chapter page - compiled once, the substring test runs inside libxml2
+SECTION_HREFS = etree.XPath('//a[contains(@href, $needle)]/@href')
+
+# Validators and parsed results per section URL - unchanged pages come back as 304s on re-runs
+CACHE_FILE = "scrape_cache.json"
+
 # Define chapters with their full paths and output filenames
 CHAPTERS = [
     {
@@ -19,27 +38,85 @@ CHAPTERS = [
     }
 ]
 
-def scrape_section(section_url, chapter_num):
-    """Scrape an individual section page"""
-    res = requests.get(section_url)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, "html.parser")
+class RateLimiter:
+    """Space requests at least 1/rate seconds apart without waiting when the schedule is already behind"""
+    
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_allowed = 0.0
+    
+    async def wait(self):
+        # Reserve the next slot before sleeping so concurrent callers queue up behind each other
+        now = time.monotonic()
+        slot = max(self.next_allowed, now)
+        self.next_allowed = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+rate_limiter = RateLimiter(SCRAPE_RATE)
+
+async def fetch_html(session, url):
+    """Fetch a page and return its HTML"""
+    await rate_limiter.wait()
+    async with session.get(url) as res:
+        res.raise_for_status()
+        return await res.text()
+
+def load_cache():
+    """Load the conditional-request cache left by the previous run"""
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_cache(cache):
+    """Save the conditional-request cache for the next run"""
+    with open(CACHE_FILE, "w") as f:
+        json.dump(cache, f)
+
+async def scrape_section(session, section_url, chapter_num, cache):
+    """Scrape an individual section page, reusing the cached result when the server reports it unchanged"""
+    cached = cache.get(section_url)
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
     
-    main = soup.find('main')
-    if not main:
+    await rate_limiter.wait()
+    async with session.get(section_url, headers=headers) as res:
+        if res.status == 304 and cached:
+            return cached['parsed']
+        res.raise_for_status()
+        html = await res.text()
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+    
+    section_data = parse_section(html, chapter_num)
+    if etag or last_modified:
+        cache[section_url] = {'etag': etag, 'last_modified': last_modified, 'parsed': section_data}
+    return section_data
+
+def parse_section(html, chapter_num):
+    """Extract the section number, title and law text from a section page"""
+    tree = lxml.html.fromstring(html)
+    
+    main = tree.find('.//main')
+    if main is None:
         return None
     
     # Get section number from H1
-    h1 = main.find('h1')
-    section_num = h1.get_text(strip=True) if h1 else "Unknown"
+    h1 = main.find('.//h1')
+    section_num = h1.text_content().strip() if h1 is not None else "Unknown"
     
     # Get law text from paragraphs
-    paragraphs = main.find_all('p')
     law_text = []
     seen_text = set()  # Track duplicates
     
-    for p in paragraphs:
-        text = p.get_text(strip=True)
+    for p in main.iter('p'):
+        text = p.text_content().strip()
         # Filter out navigation, social media, and duplicate paragraphs
         if (len(text) > 30 and 
             'MyLegislature' not in text and 
@@ -70,52 +147,78 @@ def scrape_section(section_url, chapter_num):
         "text": full_text
     }
 
-def scrape_chapter(chapter_num, chapter_path, output_file):
+async def scrape_chapter(session, chapter_num, chapter_path, output_file, cache, position=0):
     """Get all section links from chapter page and scrape each section"""
     url = f"{BASE_URL}/{chapter_path}"
-    print(f"\nScraping chapter {chapter_num} from {url}")
+    tqdm.write(f"Scraping chapter {chapter_num} from {url}")
     
-    res = requests.get(url)
-    res.raise_for_status()
-    soup = BeautifulSoup(res.text, "html.parser")
+    tree = lxml.html.fromstring(await fetch_html(session, url))
     
     # Find all links to sections
-    section_links = []
-    for link in soup.find_all('a', href=True):
-        href = link.get('href')
-        if href and f'/Chapter{chapter_num}/Section' in href:
-            full_url = f"https://malegislature.gov{href}"
-            section_links.append(full_url)
-    
-    print(f"Found {len(section_links)} sections in chapter {chapter_num}")
-    
-    data = []
-    for i, section_url in enumerate(section_links, 1):
-        print(f"  Scraping section {i}/{len(section_links)}...", end='\r')
-        section_data = scrape_section(section_url, chapter_num)
-        if section_data:
-            data.append(section_data)
-        time.sleep(0.5)  # Be respectful to the server
-    
-    print(f"  Completed {len(data)} sections from chapter {chapter_num}     ")
-    
-    # Save to individual output file
-    with open(output_file, "w") as f:
-        json.dump(data, f, indent=2)
-    print(f"  Saved to {output_file}")
-    
-    return data
-
-# Scrape each chapter and save to separate files
-total_sections = 0
-for chapter in CHAPTERS:
-    chapter_data = scrape_chapter(
-        chapter["number"], 
-        chapter["path"], 
-        chapter["output_file"]
-    )
-    total_sections += len(chapter_data)
-
-print(f"\n{'='*50}")
-print(f"Total: Scraped {total_sections} sections across {len(CHAPTERS)} chapters")
-print(f"{'='*50}")
\ No newline at end of file
+    section_links = [
+        f"https://malegislature.gov{href}"
+        for href in SECTION_HREFS(tree, needle=f'/Chapter{chapter_num}/Section')
+    ]
+    
+    tqdm.write(f"Found {len(section_links)} sections in chapter {chapter_num}")
+    
+    # Fetch sections concurrently, writing each one out in page order as soon as it and
+    # every section before it are done - one section per line keeps the file a JSON array
+    semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    # One bar line per chapter - chapters are scraped side by side
+    progress = tqdm(total=len(section_links), desc=f"  Chapter {chapter_num}", unit="section",
+                    position=position, leave=True)
+    
+    async def scrape_limited(section_url):
+        async with semaphore:
+            section_data = await scrape_section(session, section_url, chapter_num, cache)
+        progress.update()
+        return section_data
+    
+    tasks = [asyncio.create_task(scrape_limited(section_url)) for section_url in section_links]
+    section_count = 0
+    # Stream into a temp file and only replace the previous output once every section succeeded
+    tmp_file = output_file + ".tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            f.write("[")
+            for task in tasks:
+                section_data = await task
+                if section_data:
+                    f.write(",\n" if section_count else "\n")
+                    f.write(json.dumps(section_data))
+                    section_count += 1
+            f.write("\n]\n")
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        progress.close()
+    
+    tqdm.write(f"  Completed {section_count} sections from chapter {chapter_num}, saved to {output_file}")
+    
+    return section_count
+
+async def main():
+    """Scrape each chapter and save to separate files"""
+    cache = load_cache()
+    connector = aiohttp.TCPConnector(limit_per_host=SCRAPE_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector, headers=SCRAPE_HEADERS) as session:
+        # Chapters are independent - scrape them side by side over the shared connection pool
+        results = await asyncio.gather(*(
+            scrape_chapter(session, chapter["number"], chapter["path"], chapter["output_file"], cache, position=i)
+            for i, chapter in enumerate(CHAPTERS)
+        ))
+    save_cache(cache)
+    total_sections = sum(results)
+    
+    print(f"\n{'='*50}")
+    print(f"Total: Scraped {total_sections} sections across {len(CHAPTERS)} chapters")
+    print(f"{'='*50}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,8 +4,17 @@ End-to-end test of the two-stage RAG analysis workflow
 import sys
 import os
 import json
+import asyncio
+from collections import Counter
 from pathlib import Path
 from datetime import datetime
+from tqdm import tqdm
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Add scripts directory to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'scripts'))
@@ -15,6 +24,21 @@ from document_chunker import DocumentChunker
 from rag_analyzer import RAGAnalyzer
 
 
+async def extract_metadata_and_search_laws(analyzer: RAGAnalyzer, chunker: DocumentChunker,
+                                           lease_text: str, pdf_path: str):
+    """Extract metadata with Gemini while chunking the lease and searching laws for every chunk"""
+    def chunk_and_search():
+        lease_chunks = chunker.chunk_document(lease_text, max_tokens=4000)
+        # Embed and search every chunk in one Snowflake query
+        laws_by_chunk = analyzer.search_relevant_laws_batch([chunk['text'] for chunk in lease_chunks], top_k=8)
+        return lease_chunks, [laws_by_chunk[i] for i in range(len(lease_chunks))]
+    
+    return await asyncio.gather(
+        asyncio.to_thread(analyzer.extract_metadata, lease_text, pdf_path),
+        asyncio.to_thread(chunk_and_search),
+    )
+
+
 def test_full_workflow(pdf_path: str, output_path: str = None):
     """
     Test complete two-stage workflow
@@ -51,9 +75,11 @@ def test_full_workflow(pdf_path: str, output_path: str = None):
         lease_text = extractor.extract_text(pdf_path)
         print(f"   ✅ Extracted {len(lease_text)} characters")
         
-        # Extract metadata
-        print("\n📋 Extracting document metadata with Gemini...")
-        metadata = analyzer.extract_metadata(lease_text, pdf_path)
+        # Extract metadata while the lease is chunked and searched for Stage 2
+        print("\n📋 Extracting document metadata with Gemini (chunking and law search run alongside)...")
+        metadata, (lease_chunks, laws_per_chunk) = asyncio.run(
+            extract_metadata_and_search_laws(analyzer, chunker, lease_text, pdf_path)
+        )
         
         print("\n✅ Metadata extraction complete!")
         print("\nExtracted Metadata:")
@@ -71,23 +97,17 @@ def test_full_workflow(pdf_path: str, output_path: str = None):
         print("STAGE 2: FULL RAG ANALYSIS")
         print("=" * 80)
         
-        print("\n📝 Chunking document...")
-        lease_chunks = chunker.chunk_document(lease_text, max_tokens=4000)
-        print(f"   ✅ Created {len(lease_chunks)} chunks")
+        print(f"\n📝 Chunked document into {len(lease_chunks)} chunks")
         
         print("\n🔍 Analyzing chunks against MA laws...")
-        chunk_analyses = []
-        for i, chunk in enumerate(lease_chunks):
-            print(f"   Analyzing chunk {i+1}/{len(lease_chunks)}...", end='\r')
-            
-            # Search for relevant laws
-            relevant_laws = analyzer.search_relevant_laws(chunk['text'], top_k=8)
-            
-            # Analyze chunk
-            analysis = analyzer.analyze_chunk(chunk, relevant_laws)
-            chunk_analyses.append(analysis)
-            
-            # Print summary
+        with tqdm(total=len(lease_chunks), desc="   Analyzing chunks", unit="chunk") as progress:
+            chunk_analyses = analyzer.analyze_chunks(
+                lease_chunks, laws_per_chunk,
+                progress_callback=lambda completed, total: progress.update(completed - progress.n)
+            )
+        
+        # Print summary
+        for i, analysis in enumerate(chunk_analyses):
             illegal_count = len(analysis.get('illegal_clauses', []))
             risky_count = len(analysis.get('risky_terms', []))
             if illegal_count > 0 or risky_count > 0:
@@ -126,27 +146,25 @@ def test_full_workflow(pdf_path: str, output_path: str = None):
         print("=" * 80)
         
         summary = final_analysis.get('analysisSummary', {})
+        highlights = final_analysis.get('highlights', [])
         print(f"\n📈 Overall Risk: {summary.get('overallRisk', 'Unknown')}")
         print(f"   Issues Found: {summary.get('issuesFound', 0)}")
         print(f"   Potential Recovery: {summary.get('estimatedRecovery', '$0')}")
-        print(f"   Highlights: {len(final_analysis.get('highlights', []))}")
+        print(f"   Highlights: {len(highlights)}")
         
         # Count by color
-        highlights = final_analysis.get('highlights', [])
-        red_count = len([h for h in highlights if h['color'] == 'red'])
-        orange_count = len([h for h in highlights if h['color'] == 'orange'])
-        yellow_count = len([h for h in highlights if h['color'] == 'yellow'])
-        green_count = len([h for h in highlights if h['color'] == 'green'])
+        color_counts = Counter(h['color'] for h in highlights)
         
-        print(f"\n   🔴 Red (Illegal): {red_count}")
-        print(f"   🟠 Orange (High Risk): {orange_count}")
-        print(f"   🟡 Yellow (Medium Risk): {yellow_count}")
-        print(f"   🟢 Green (Favorable): {green_count}")
+        print(f"\n   🔴 Red (Illegal): {color_counts['red']}")
+        print(f"   🟠 Orange (High Risk): {color_counts['orange']}")
+        print(f"   🟡 Yellow (Medium Risk): {color_counts['yellow']}")
+        print(f"   🟢 Green (Favorable): {color_counts['green']}")
         
         # Show top issues
-        if summary.get('topIssues'):
+        top_issues = summary.get('topIssues')
+        if top_issues:
             print("\n   Top Issues:")
-            for i, issue in enumerate(summary['topIssues'][:3], 1):
+            for i, issue in enumerate(top_issues[:3], 1):
                 print(f"   {i}. {issue['title']} - {issue['severity']} ({issue['amount']})")
         
         # Save output
@@ -156,10 +174,15 @@ def test_full_workflow(pdf_path: str, output_path: str = None):
             output_path = f"{pdf_name}_analysis_output.json"
         
         print(f"\n💾 Saving analysis to: {output_path}")
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(final_analysis, f, indent=2, ensure_ascii=False)
+        if ORJSON_AVAILABLE:
+            output = orjson.dumps(final_analysis, option=orjson.OPT_INDENT_2)
+        else:
+            output = json.dumps(final_analysis, indent=2, ensure_ascii=False).encode('utf-8')
+        with open(output_path, 'wb') as f:
+            f.write(output)
+        output_size = len(output)
         
-        print(f"   ✅ Saved {os.path.getsize(output_path) // 1024} KB")
+        print(f"   ✅ Saved {output_size // 1024} KB")
         
         # Validate JSON structure
         print("\n✅ Validating JSON structure...")